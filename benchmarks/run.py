@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# Benchmarks for whelk. Results are written as json and can be compared
+# against a stored baseline, to find out whether a change makes things faster
+# or slower:
+#
+#   python benchmarks/run.py --save-baseline   # before the change
+#   python benchmarks/run.py                   # after the change
+#
+# Benchmarks only use standard unix tools, so they don't need a network or
+# anything else that isn't on a normal linux machine.
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from whelk import Shell, Pipe, Trace
+
+MB = 1024 * 1024
+benchmarks = []
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+def timed(func, rounds):
+    """Best time per call of func, over a few rounds"""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        elapsed = (time.perf_counter() - start) / rounds
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def result(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+@benchmark
+def lookup(quick):
+    shell = Shell()
+    shell.which('cat')
+    yield 'lookup', result(timed(lambda: shell._getitem('cat', defer=False), 10000) * 1e6, 'us')
+    yield 'lookup_missing', result(timed(lambda: 'no-such-command' in shell, 10000) * 1e6, 'us')
+
+@benchmark
+def call_overhead(quick):
+    rounds = 20 if quick else 200
+    for spawn in ('fork', 'posix_spawn', 'server'):
+        shell = Shell(spawn=spawn)
+        yield 'call_%s' % spawn, result(timed(shell.true, rounds) * 1e3, 'ms')
+    shell = Shell(trace=Trace())
+    yield 'call_traced', result(timed(shell.true, rounds) * 1e3, 'ms')
+
+@benchmark
+def spawn_rate(quick):
+    # Processes started per second by a big, multi-threaded process, for all
+    # spawn methods
+    rounds = 20 if quick else 200
+    ballast = b'x' * ((256 if quick else 2048) * MB)
+    done = threading.Event()
+    threads = [threading.Thread(target=done.wait) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    try:
+        for spawn in ('fork', 'posix_spawn', 'server'):
+            shell = Shell(spawn=spawn)
+            yield 'spawn_rate_%s' % spawn, result(1 / timed(shell.true, rounds), '/s', 'higher')
+    finally:
+        done.set()
+        del ballast
+
+@benchmark
+def pipe_throughput(quick):
+    pipe = Pipe()
+    for size in ((1, 16) if quick else (1, 16, 128)):
+        data = b'x' * (size * MB)
+        for stages in (1, 2, 4):
+            def run():
+                cmd = pipe.cat(input=data)
+                for _ in range(stages - 1):
+                    cmd = cmd | pipe.cat()
+                pipe(cmd)
+            yield 'pipe_%d_stages_%dmb' % (stages, size), result(size / timed(run, 1), 'MB/s', 'higher')
+
+@benchmark
+def callback_overhead(quick):
+    shell = Shell()
+    size = 16 if quick else 128
+    calls = []
+    def callback(cmd, sp, fd, data):
+        calls.append(data)
+    for read_size in (4096, 65536):
+        plain = timed(lambda: shell.head('-c', size * MB, '/dev/zero', read_size=read_size), 1)
+        cb = timed(lambda: shell.head('-c', size * MB, '/dev/zero', read_size=read_size, output_callback=callback), 1)
+        del calls[:]
+        yield 'callback_overhead_%d' % read_size, result((cb - plain) / size * 1e3, 'ms/MB')
+
+@benchmark
+def capture_memory(quick):
+    shell = Shell()
+    size = 16 if quick else 128
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        shell.head('-c', size * MB, '/dev/zero')
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # Peak memory use as a multiple of the size of the output
+    yield 'capture_memory', result(peak / (size * MB), 'x')
+
+def compare(results, baseline, threshold):
+    """Generates (name, change) for results that are more than threshold
+       worse than the baseline"""
+    for name, res in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], res['value']
+        if not old:
+            continue
+        change = (new - old) / old
+        if res['better'] == 'higher':
+            change = -change
+        if change > threshold:
+            yield name, change
+
+def main():
+    default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+    parser = argparse.ArgumentParser(description="Run whelk benchmarks")
+    parser.add_argument('--quick', action='store_true', help="Use less data and fewer rounds")
+    parser.add_argument('--output', help="Write results to this file instead of stdout")
+    parser.add_argument('--baseline', default=default_baseline, help="Baseline to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Report slowdowns bigger than this fraction (default 0.2)")
+    parser.add_argument('filter', nargs='*', help="Only run benchmarks whose name contains one of these")
+    args = parser.parse_args()
+
+    results = {}
+    for func in benchmarks:
+        if args.filter and not any(f in func.__name__ for f in args.filter):
+            continue
+        for name, res in func(args.quick):
+            results[name] = res
+            sys.stderr.write("%-30s %12.3f %s\n" % (name, res['value'], res['unit']))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as fd:
+        baseline = json.load(fd)
+    regressions = list(compare(results, baseline, args.threshold))
+    for name, change in regressions:
+        sys.stderr.write("Regression: %s is %.0f%% worse than the baseline\n" % (name, change * 100))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
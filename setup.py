@@ -9,6 +9,7 @@ setup(name = "whelk",
       url = "http://github.com/seveas/whelk",
       description = "Easy access to shell commands from python",
       packages = ["whelk"],
+      python_requires = ">=3.9",
       classifiers = [
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
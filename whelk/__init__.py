@@ -29,32 +29,334 @@
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
-class Result(tuple):
-    __slots__ = ()
-    def __new__(cls, returncode, stdout, stderr):
-        return tuple.__new__(cls, (returncode, stdout, stderr))
+class Parsers(object):
+    """Incremental parsers for output. Records are generated as they are
+       found and decoded one at a time, so large outputs are never copied or
+       decoded as a whole."""
+    def records(self, separator='\n', encoding=None, errors=None):
+        """Generates records separated by separator, for example '\\0' for
+           the output of find -print0. Records are decoded if an encoding is
+           given, and are bytes otherwise, unless the output is text."""
+        return _records(_decoded(self._chunks(), encoding, errors), separator)
+
+    def fields(self, delimiter=':', separator='\n', maxsplit=-1, encoding=None, errors=None):
+        """Generates lists of fields, like those of getent or /etc/passwd"""
+        for record in self.records(separator, encoding, errors):
+            yield record.split(_like(delimiter, record), maxsplit)
+
+    def json_lines(self, encoding=None, errors=None):
+        """Generates the objects in JSON Lines output, skipping empty lines"""
+        import json
+        for record in self.records('\n', encoding, errors):
+            if record.strip():
+                yield json.loads(record)
+
+    def csv(self, encoding=None, errors=None, **fmtparams):
+        """Generates the rows of CSV output, as lists of strings. Output that
+           isn't text is decoded with the given encoding, or that of the
+           locale. Other keyword arguments are passed to csv.reader."""
+        import csv
+        chunks = _decoded(self._chunks(), encoding or locale.getpreferredencoding(False), errors)
+        return csv.reader(_records(chunks, '\n', keepends=True), **fmtparams)
+
+class Result(Parsers, tuple):
+    def __new__(cls, returncode, stdout, stderr, usage=None, stage_stderr=None):
+        self = tuple.__new__(cls, (returncode, stdout, stderr))
+        self.usage = usage
+        self.stage_stderr = stage_stderr
+        return self
     def __repr__(self):
         return 'Result' + super(Result, self).__repr__()
     returncode = property(lambda self: self[0])
     stdout = property(lambda self: self[1])
     stderr = property(lambda self: self[2])
     def __nonzero__(self):
-        if isinstance(self.returncode, int):
-            return self.returncode == 0
-        return self.returncode.count(0) == len(self.returncode)
+        return _succeeded(self.returncode)
     __bool__ = __nonzero__
+    def _chunks(self):
+        if self.stdout is None:
+            raise ValueError("Output was not collected")
+        return _slices(self.stdout, IOPump.read_size)
 
+import atexit
+import codecs
+import collections
+import copy
+import errno
+import hashlib
+import io
+import itertools
+import locale
+import mmap
 import os
+import pickle
+try:
+    import resource
+except ImportError:
+    # Not available on windows
+    resource = None
+import select
+import selectors
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 Popen = subprocess.Popen
 
-__all__ = ['Shell', 'Pipe', 'shell', 'pipe', 'PIPE', 'STDOUT', 'DEVNULL', 'CommandFailed']
+__all__ = ['Shell', 'Pipe', 'AsyncShell', 'AsyncPipe', 'ResultCache', 'Trace', 'shell', 'pipe', 'PIPE', 'STDOUT', 'DEVNULL', 'CommandFailed']
 # Mirror some subprocess constants
 PIPE = subprocess.PIPE
 STDOUT = subprocess.STDOUT
 DEVNULL = subprocess.DEVNULL
+# All keyword arguments Popen accepts
+_popen_kwargs = Popen.__init__.__code__.co_varnames[2:Popen.__init__.__code__.co_argcount] + tuple(Popen.__init__.__kwdefaults__)
+
+class PathIndex(object):
+    """An index of the executables on $PATH. Directories are listed once and
+       lookups are cached, including failed ones. The index is rebuilt when
+       $PATH changes, and directories are rescanned when their mtime changes.
+       Those mtimes are checked at most once every `interval` seconds."""
+    interval = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.dirs = []
+        self.cache = {}
+        self.checked = 0
+
+    def invalidate(self):
+        """Forget everything, the next lookup will rescan $PATH"""
+        with self.lock:
+            self.path = None
+
+    def _scan(self, d):
+        try:
+            mtime = os.stat(d or os.curdir).st_mtime_ns
+            with os.scandir(d or os.curdir) as entries:
+                names = frozenset(entry.name for entry in entries)
+        except OSError:
+            return (d, None, frozenset())
+        return (d, mtime, names)
+
+    def _refresh(self):
+        path = os.environ.get('PATH', os.defpath)
+        now = time.monotonic()
+        if path != self.path:
+            dirs = []
+            for d in path.split(os.pathsep):
+                if d.endswith('"') and d.startswith('"'):
+                    d = d[1:-1]
+                dirs.append(self._scan(d))
+            self.path, self.dirs, self.cache, self.checked = path, dirs, {}, now
+        elif now - self.checked >= self.interval:
+            for i, (d, mtime, names) in enumerate(self.dirs):
+                try:
+                    new_mtime = os.stat(d or os.curdir).st_mtime_ns
+                except OSError:
+                    new_mtime = None
+                if new_mtime != mtime:
+                    self.dirs[i] = self._scan(d)
+                    self.cache = {}
+            self.checked = now
+
+    def which(self, name):
+        """Return the full path to a command, or None if it can't be found"""
+        with self.lock:
+            self._refresh()
+            if name in self.cache:
+                return self.cache[name]
+            candidates = [name]
+            if sys.platform == 'win32' and not name.endswith('.exe'):
+                candidates.insert(0, name + '.exe')
+            # Try a translation from _ to - as python identifiers can't
+            # contain -
+            name_ = name.replace('_','-')
+            if name != name_:
+                candidates.append(name_)
+            found = None
+            for d, mtime, names in self.dirs:
+                for c in candidates:
+                    if c not in names:
+                        continue
+                    p = os.path.join(d, c)
+                    if os.path.isfile(p) and os.access(p, os.X_OK):
+                        found = p
+                        break
+                if found:
+                    break
+            self.cache[name] = found
+            return found
+
+class ResultCache(object):
+    """A cache for results of commands that always produce the same output
+       for the same arguments, input, working directory and environment. Only
+       the environment variables named in env are taken into account, unless
+       a command gets an explicit environment. Commands can also depend on
+       the modification time of files with the cache_files argument.
+
+       At most maxsize results and maxbytes bytes of output are kept in
+       memory, the least recently used ones are evicted first. Results expire
+       after ttl seconds. If a path is given, results are also stored as
+       files in that directory, so they can be shared between processes. At
+       most maxsize of those are kept as well. The directory must be owned by
+       the current user and not be writable by anyone else, as other users
+       could make commands return anything they like."""
+    def __init__(self, maxsize=1024, maxbytes=None, ttl=None, env=(), path=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.env = tuple(env)
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            st = os.stat(path)
+            if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+                raise PermissionError("Cache directory %s is not owned by the current user" % path)
+            if st.st_mode & 0o022:
+                raise PermissionError("Cache directory %s is writable by other users" % path)
+
+    def key(self, command):
+        """The cache key for a command, or None if its result can't be
+           cached. That is the case for pipes, streams, background jobs,
+           commands with an output callback, commands that may spill their
+           output to disk and commands that read their input from or write
+           their output to anything but whelk."""
+        kwargs = command.sp_kwargs
+        if command.defer or command.stream or command.background or command.output_callback or command.sinks or command.spill is not None:
+            return None
+        if _is_source(command.input):
+            return None
+        if kwargs.get('stdin') != PIPE or kwargs.get('stdout') not in (PIPE, DEVNULL) or kwargs.get('stderr') not in (PIPE, STDOUT, DEVNULL):
+            return None
+        input = command.input or b''
+        if isinstance(input, str):
+            input = input.encode('utf-8', 'surrogatepass')
+        env = kwargs.get('env')
+        if env is None:
+            env = [(name, os.environ.get(name)) for name in self.env]
+        else:
+            env = sorted(env.items())
+        cwd = os.path.join(os.getcwd(), os.fsdecode(kwargs['cwd']) if kwargs.get('cwd') else '')
+        files = []
+        for f in command.cache_files:
+            try:
+                files.append((os.fspath(f), os.stat(os.path.join(cwd, f)).st_mtime_ns))
+            except OSError:
+                files.append((os.fspath(f), None))
+        key = (command.name, [str(x) for x in command.args], hashlib.sha256(input).hexdigest(), cwd, env, files,
+               kwargs['stdout'], kwargs['stderr'], command.encoding, command.errors, command.text, kwargs.get('universal_newlines'))
+        return hashlib.sha256(repr(key).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def get(self, key):
+        """Returns the (returncode, stdout, stderr) tuple stored for key, or
+           None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and self.ttl is not None and now - entry[0] > self.ttl:
+                self._evict(key)
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        entry = self.path and self._load(key)
+        with self.lock:
+            if entry and (self.ttl is None or now - entry[0] <= self.ttl):
+                self._store(key, entry)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+    def put(self, key, result):
+        """Store a (returncode, stdout, stderr) tuple"""
+        entry = (time.time(), tuple(result))
+        with self.lock:
+            self._store(key, entry)
+        if self.path:
+            self._save(key, entry)
+
+    def clear(self):
+        """Forget all results, including the ones on disk"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.path:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.result'):
+                    os.unlink(entry.path)
+
+    def _store(self, key, entry):
+        if key in self.entries:
+            self._evict(key)
+        self.entries[key] = entry
+        self.size += _result_size(entry[1])
+        while self.entries and (len(self.entries) > self.maxsize or (self.maxbytes is not None and self.size > self.maxbytes)):
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key):
+        self.size -= _result_size(self.entries.pop(key)[1])
+
+    def _load(self, key):
+        import json
+        path = os.path.join(self.path, key + '.result')
+        try:
+            with open(path, 'rb') as fd:
+                data = json.load(fd)
+            entry = (float(data['time']), (int(data['returncode']), _unpack_output(data['stdout']), _unpack_output(data['stderr'])))
+            # Keep track of when it was used last, for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return entry
+
+    def _save(self, key, entry):
+        import json
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        (returncode, stdout, stderr) = entry[1]
+        data = {'time': entry[0], 'returncode': returncode, 'stdout': _pack_output(stdout), 'stderr': _pack_output(stderr)}
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(data, fd)
+        os.replace(tmp, os.path.join(self.path, key + '.result'))
+        entries = [entry for entry in os.scandir(self.path) if entry.name.endswith('.result')]
+        if len(entries) > self.maxsize:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.maxsize]:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+def _pack_output(output):
+    """Cached output as json, it's never unpickled, so cache files can't
+       run code"""
+    import base64
+    if output is None:
+        return None
+    if isinstance(output, str):
+        return {'text': output}
+    return {'bytes': base64.b64encode(output).decode('ascii')}
+
+def _unpack_output(data):
+    import base64
+    if data is None:
+        return None
+    if 'text' in data:
+        return str(data['text'])
+    return base64.b64decode(data['bytes'], validate=True)
+
+def _result_size(result):
+    return sum(len(x) for x in result[1:] if x is not None)
 
 class Shell(object):
     """The magic shell class that finds executables on your $PATH"""
@@ -62,6 +364,10 @@ class Shell(object):
     # import shell'
     PIPE = PIPE
     STDOUT = STDOUT
+    # Shared by all instances, $PATH is process-wide anyway
+    path_index = PathIndex()
+    # Set by subclasses that need different command objects, see AsyncShell
+    command_class = None
 
     def __init__(self, **kwargs):
         self.defaults = kwargs
@@ -74,6 +380,90 @@ class Shell(object):
     def __getitem__(self, name):
         return self._getitem(name, defer=False)
 
+    def __contains__(self, name):
+        return self.which(name) is not None
+
+    def which(self, name):
+        """Return the full path to a command, or None if it can't be found"""
+        if '/' in name:
+            return name if os.access(name, os.X_OK) else None
+        return self.path_index.which(name)
+
+    def map(self, cmd, argsets, max_workers=None, ordered=True, fail_fast=False, **kwargs):
+        """Run a command for every set of arguments, with up to max_workers
+           (default: the number of cpus) processes at the same time. Keyword
+           arguments are passed to all commands. Results are generated in
+           order, or as they complete if ordered is False. With fail_fast, no
+           new commands are started after one fails, and CommandFailed is
+           raised for the failed command."""
+        return self._map(self.prepare(cmd, defer=False, **kwargs), argsets, max_workers, ordered, fail_fast)
+
+    def _map(self, command, argsets, max_workers, ordered, fail_fast):
+        import concurrent.futures
+        failed = threading.Event()
+        def run(args):
+            if failed.is_set():
+                # Skipped, results() passes over it
+                return None
+            try:
+                res = command(*args)
+            except CommandFailed:
+                if fail_fast:
+                    failed.set()
+                raise
+            if fail_fast and not res:
+                failed.set()
+            return res
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count())
+        futures = [executor.submit(run, _argset(args)) for args in argsets]
+        def results():
+            try:
+                for future in (futures if ordered else concurrent.futures.as_completed(futures)):
+                    res = future.result()
+                    if res is None:
+                        continue
+                    if fail_fast and not res:
+                        raise CommandFailed(res)
+                    yield res
+            finally:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+        return results()
+
+    def batched(self, cmd, args, initial=(), max_workers=None, max_args=None, fail_fast=False, **kwargs):
+        """Run a command (or the name of one) for a large number of arguments,
+           like xargs. The arguments are split into batches of at most
+           max_args arguments, which fit in the system's limit for the size of
+           the arguments and environment of a new process. The initial
+           arguments come before those of every batch. Batches run in
+           parallel, like with map, and a single result is returned: the
+           returncodes and usage of all batches, in order, and their output
+           joined in the same order. Output that goes anywhere but back to
+           whelk is written there when all batches are done."""
+        command = self.prepare(cmd, *initial, defer=False, **kwargs)
+        batches = _batches(command.command, args, max_args)
+        targets = _redirect(command.command)
+        return _combined(command.command, list(self._map(command, batches, max_workers, True, fail_fast)), targets)
+
+    def prepare(self, cmd, *args, **kwargs):
+        """Returns a command (or the name of one) with arguments and keyword
+           arguments that are processed only once, for commands that are run
+           many times. Calling it runs the command with these arguments,
+           followed by the ones passed in the call."""
+        if not isinstance(cmd, Command):
+            cmd = self[cmd]
+        return PreparedCommand(copy.copy(cmd), args, kwargs)
+
+    def py(self, func, *args, **kwargs):
+        """A pipe stage that runs a python function in a thread instead of
+           running a process. The function is called with an iterator over
+           the lines of its input, followed by args, and can return or
+           generate output."""
+        if self.command_class:
+            raise TypeError("Python stages can't be used with asyncio")
+        return PythonStage(func, defer=isinstance(self, Pipe), defaults=self.defaults)(*args, **kwargs)
+
     def _getattr(self, name, defer):
         """Locate the command on the PATH"""
         try:
@@ -86,27 +476,22 @@ class Shell(object):
 
     def _getitem(self, name, defer, try_path=True):
         if try_path and '/' in name and os.access(name, os.X_OK):
-            return Command(name,defer=defer,defaults=self.defaults)
-        name_ = name.replace('_','-')
-        for d in os.environ['PATH'].split(os.pathsep):
-            if d.endswith('"') and d.startswith('"'):
-                d=d[1:-1]
-            if sys.platform == 'win32' and not name.endswith('.exe'):
-                p = os.path.join(d, name) + '.exe'
-                if os.path.isfile(p) and os.access(p, os.X_OK):
-                    return Command(p,defer=defer,defaults=self.defaults)
-            p = os.path.join(d, name)
-            if os.path.isfile(p) and os.access(p, os.X_OK):
-                return Command(p,defer=defer,defaults=self.defaults)
-            # Try a translation from _ to - as python identifiers can't
-            # contain -
-            if name != name_:
-                p = os.path.join(d, name_)
-                if os.access(p, os.X_OK):
-                    return Command(p,defer=defer,defaults=self.defaults)
+            return (self.command_class or Command)(name,defer=defer,defaults=self.defaults)
+        p = self.path_index.which(name)
+        if p and self._builtin(name):
+            return Builtin(p,_builtins[name],defer=defer,defaults=self.defaults)
+        if p:
+            return (self.command_class or Command)(p,defer=defer,defaults=self.defaults)
         if try_path:
             raise KeyError("Command '%s' not found" % name)
 
+    def _builtin(self, name):
+        """Whether to use the python implementation of a command"""
+        builtins = self.defaults.get('builtins')
+        if not builtins or self.command_class or name not in _builtins:
+            return False
+        return builtins is True or name in builtins
+
 class Pipe(Shell):
     """Shell subclass that returns deferred commands"""
     def __getattr__(self, name):
@@ -120,6 +505,13 @@ class Pipe(Shell):
         """Run the last command in the pipeline and return data"""
         return cmd.run_pipe()
 
+    def fanout(self, *branches, **kwargs):
+        """The end of a pipe that sends the output of the previous process to
+           all branches, which are pipes or commands themselves"""
+        if self.command_class:
+            raise TypeError("Fanout can't be used with asyncio")
+        return Fanout(branches, defaults=self.defaults)(**kwargs)
+
 class Command(object):
     """A subprocess wrapper that executes the program when called or when
        combined with the or operator for pipes"""
@@ -130,7 +522,32 @@ class Command(object):
 
     def __call__(self, *args, **kwargs):
         """Save arguments, execute a subprocess unless we need to be deferred"""
-        self.args = args[:]
+        self._parse_args(args, kwargs)
+        return self._start()
+
+    def _start(self):
+        if not self.defer:
+            # No need to defer, so call ourselves
+            if self.cache_key:
+                cached = self.cache.get(self.cache_key)
+                if cached:
+                    return self._result(None, *cached)
+            sp = self._popen()
+            if self.stream:
+                return Stream(self, sp, sp.stdin, self.input)
+            if self.background:
+                return Job(self, sp, sp.stdin, self.input)
+            pump = IOPump(self, sp)
+            pump.watch([sp])
+            (out, err) = pump.communicate(sp.stdin, self.input)
+            return self._finish(sp, out, err, pump)
+        # When defering, return ourselves
+        self.next = self.prev = None
+        return self
+
+    def _parse_args(self, args, kwargs):
+        """Save arguments and separate our own keyword arguments from the
+           ones for Popen"""
         self.kwargs = kwargs.copy()
 
         # When not specified, make sure stdio is coming back to us
@@ -143,7 +560,7 @@ class Command(object):
         if sys.platform != 'win32' or (kwargs.get('stdin'), kwargs.get('stdout', None), kwargs.get('stderr', None)).count(None) == 3:
             kwargs['close_fds'] = True
 
-        self.input = kwargs.pop('input','')
+        input = kwargs.pop('input','')
         self.encoding = kwargs.get('encoding', self.defaults.get('encoding', None))
         self.errors = kwargs.get('errors', self.defaults.get('errors', None))
         self.text = kwargs.get('text', self.defaults.get('text', None))
@@ -160,53 +577,150 @@ class Command(object):
         if callable(self.run_callback):
             self.run_callback = [self.run_callback]
         self.raise_on_error = kwargs.pop('raise_on_error', self.defaults.get('raise_on_error', False))
-
-        stdout_reader = stderr_reader = None
-        if self.output_callback:
-            if kwargs['stdout'] == PIPE:
-                stdout_reader = ReaderThread(self)
-                kwargs['stdout'] = stdout_reader.writefd
-            if kwargs['stderr'] == PIPE:
-                stderr_reader = ReaderThread(self)
-                kwargs['stderr'] = stderr_reader.writefd
+        self.read_size = kwargs.pop('read_size', self.defaults.get('read_size', None))
+        self.stream = kwargs.pop('stream', self.defaults.get('stream', False))
+        self.background = kwargs.pop('background', self.defaults.get('background', False))
+        self.timeout = kwargs.pop('timeout', self.defaults.get('timeout', None))
+        self.trace = kwargs.pop('trace', self.defaults.get('trace', None))
+        self.cache = kwargs.pop('cache', self.defaults.get('cache', None))
+        if self.cache is True:
+            self.cache = result_cache
+        self.cache_files = kwargs.pop('cache_files', self.defaults.get('cache_files', ()))
+        self.spill = kwargs.pop('spill', self.defaults.get('spill', None))
+        self.affinity = kwargs.pop('affinity', self.defaults.get('affinity', None))
+        self.nice = kwargs.pop('nice', self.defaults.get('nice', None))
+        self.ionice = kwargs.pop('ionice', self.defaults.get('ionice', None))
+        self.rlimits = kwargs.pop('rlimits', self.defaults.get('rlimits', None))
+        # Catch mistakes now, not in the new process
+        if self.ionice is not None:
+            _ioprio(self.ionice)
+        if self.rlimits:
+            _rlimits(self.rlimits)
+        self.spawn = kwargs.pop('spawn', self.defaults.get('spawn', 'fork'))
+        self.builtins = kwargs.pop('builtins', self.defaults.get('builtins', False))
+        if self.spawn not in ('fork', 'posix_spawn', 'server'):
+            raise ValueError("Unknown spawn method: %r" % self.spawn)
 
         self.sp_kwargs = kwargs
-        all_kwargs = Popen.__init__.__code__.co_varnames[2:Popen.__init__.__code__.co_argcount] + tuple(Popen.__init__.__kwdefaults__)
-        for kwarg in all_kwargs:
+        for kwarg in _popen_kwargs:
             if kwarg in self.defaults and kwarg not in self.sp_kwargs:
                 self.sp_kwargs[kwarg] = self.defaults[kwarg]
 
-        if not self.defer:
-            # No need to defer, so call ourselves
+        # Output targets that the process can't write to itself are written
+        # to by us
+        self.sinks = {}
+        for stream in ('stdout', 'stderr'):
+            target = self.sp_kwargs.get(stream)
+            if _buffer(target) is not None or (hasattr(target, 'write') and not _real_file(target)):
+                self.sinks[stream] = Sink(target)
+                self.sp_kwargs[stream] = PIPE
+
+        # Where stdin comes from when the input isn't a file
+        self.stdin_target = self.sp_kwargs.get('stdin')
+        self._bind(args[:], input)
+
+    def _bind(self, args, input):
+        """Set the arguments and input for a single run, this is all the work
+           prepared commands do for every call"""
+        self.args = args
+        self.input = input
+        if isinstance(input, os.PathLike) or _real_file(input):
+            # No need to shovel data around, the process can read the file
+            # itself
+            self.sp_kwargs['stdin'] = input
+        elif self.stdin_target is None:
+            self.sp_kwargs.pop('stdin', None)
+        else:
+            self.sp_kwargs['stdin'] = self.stdin_target
+        self.cache_key = self.cache.key(self) if self.cache else None
+
+    def _sink(self, stream, text):
+        """Where output of stdout or stderr goes, None if it's collected in
+           memory"""
+        sink = self.sinks.get(stream)
+        if sink is None and self.spill is not None and not text:
+            sink = Spill(self.spill)
+        return sink
+
+    def _copy(self, args, input):
+        """A copy of a command whose arguments have been parsed, with extra
+           arguments and new input"""
+        cmd = copy.copy(self)
+        cmd.sp_kwargs = self.sp_kwargs.copy()
+        cmd.sinks = dict((stream, Sink(sink.target)) for (stream, sink) in self.sinks.items())
+        cmd.kwargs = dict(self.kwargs, input=input)
+        cmd._bind(self.args + args, input)
+        return cmd
+
+    def _open_files(self, kwargs):
+        """Open files that were passed by name for stdin, stdout or stderr and
+           make sure python file objects are in sync with their file
+           descriptors. Returns the opened files, which should be closed once
+           the process has started."""
+        opened = []
+        for stream in ('stdin', 'stdout', 'stderr'):
+            f = kwargs.get(stream)
+            if isinstance(f, (str, os.PathLike)):
+                f = kwargs[stream] = open(f, 'rb' if stream == 'stdin' else 'wb')
+                opened.append(f)
+            elif _real_file(f):
+                if stream != 'stdin':
+                    f.flush()
+                elif f.seekable():
+                    # Python may have read ahead, make sure the process starts
+                    # reading where python would continue
+                    os.lseek(f.fileno(), f.tell(), os.SEEK_SET)
+        return opened
+
+    def _popen(self):
+        """Start the process"""
+        kwargs = self.sp_kwargs.copy()
+        opened = self._open_files(kwargs)
+        self._limit(kwargs)
+        try:
             if self.run_callback:
                 self.run_callback[0](self, *self.run_callback[1:])
-            sp = Popen([str(self.name)] + [str(x) for x in self.args], **(self.sp_kwargs))
-            if stdout_reader:
-                stdout_reader.set_process(sp)
-            if stderr_reader:
-                stderr_reader.set_process(sp)
-            (out, err) = sp.communicate(self.input)
-            if stdout_reader:
-                stdout_reader.thread.join()
-                out = stdout_reader.output
-            if stderr_reader:
-                stderr_reader.thread.join()
-                err = stderr_reader.output
-            res = Result(sp.returncode, out, err)
-            if self.exit_callback:
-                self.exit_callback[0](self, sp, res, *self.exit_callback[1:])
-            if self.raise_on_error and res.returncode:
-                raise CommandFailed(res)
-            return res
-        # When defering, return ourselves
-        self.next = self.prev = None
-        return self
+            spawn = self.spawn
+            if isinstance(kwargs.get('preexec_fn'), Limits) and _can_spawn(kwargs, 'server'):
+                # Better than forking and running a preexec_fn
+                spawn = 'server'
+            popen = Popen
+            if _can_spawn(kwargs, spawn):
+                popen = {'posix_spawn': SpawnPopen, 'server': ServerPopen}[spawn]
+            started = time.time()
+            sp = popen([str(self.name)] + [str(x) for x in self.args], **kwargs)
+        finally:
+            for f in opened:
+                f.close()
+        sp.shell = self
+        sp.started = started
+        if self.trace:
+            self.trace.spawned(self, sp)
+        return sp
+
+    def _limit(self, kwargs):
+        """Cpu affinity, priorities and resource limits are applied by the new
+           process itself, before it runs the command, so the command never
+           runs without them. The spawn server can do this without a
+           preexec_fn, so _popen sends these commands there when it can.
+           Otherwise they need the preexec_fn."""
+        if self.affinity is None and self.nice is None and self.ionice is None and not self.rlimits:
+            return
+        kwargs['preexec_fn'] = Limits(self.affinity, self.nice, self.ionice, self.rlimits, kwargs.get('preexec_fn'))
 
     def __or__(self, other):
         """Chain processes together and execute a subprocess for the first
            process in the chain"""
+        self._chain(other)
+        self.sp_kwargs['stdout'] = PIPE
+        self.sinks.pop('stdout', None)
+        self.sp = self._popen()
+        other.sp_kwargs['stdin'] = self.sp.stdout
+        return other
+
+    def _chain(self, other):
         # Can we chain the two together?
-        if not isinstance(other, self.__class__):
+        if not isinstance(other, Command) or isinstance(other, AsyncCommand) != isinstance(self, AsyncCommand):
             raise TypeError("Can only chain commands together")
         if not self.defer or not hasattr(self, 'next') or self.next:
             raise ValueError("Command not chainable or already chained")
@@ -220,84 +734,2468 @@ class Command(object):
         # Yes, we can!
         self.next = other
         other.prev = self
-        self.sp_kwargs['stdout'] = PIPE
-        if self.run_callback:
-            self.run_callback[0](self, *self.run_callback[1:])
-        self.sp = Popen([str(self.name)] + [str(x) for x in self.args], **(self.sp_kwargs))
-        self.sp.shell = self
-        other.sp_kwargs['stdin'] = self.sp.stdout
-        return other
 
     def run_pipe(self):
         """Run the last command in the pipe and collect returncodes"""
-        if self.run_callback:
-            self.run_callback[0](self, *self.run_callback[1:])
-        sp = Popen([str(self.name)] + [str(x) for x in self.args], **(self.sp_kwargs))
-        sp.shell = self
+        sp = self._popen()
         sp.output_callback = self.output_callback
+        (stdin, input) = self._pipe_input(sp)
+        if self.stream:
+            return Stream(self, sp, stdin, input)
+        if self.background:
+            return Job(self, sp, stdin, input)
+        pump = IOPump(self, sp)
+        self._drain_stderr(pump)
+        pump.watch(self._processes(sp))
+        (out, err) = pump.communicate(stdin, input)
+        return self._finish(sp, out, err, pump)
 
-        # Ugly fudging of file descriptors to make communicate() work
-        old_stdin = sp.stdin
+    def _pipe_input(self, sp):
+        """Input goes to the first process in the pipe, output comes from the
+           last one. Close the pipes between the processes, which only the
+           processes need, and return the stdin and input of the first
+           process."""
+        stdin = sp.stdin
+        input = self.input
         proc = self.prev
-        input = ''
         while proc:
-            sp.stdin = proc.sp.stdin
+            stdin = proc.sp.stdin
             input = proc.input
             if proc.sp.stdout:
                 proc.sp.stdout.close()
                 proc.sp.stdout = None
-            if proc.sp.stderr:
-                proc.sp.stderr.close()
-                proc.sp.stderr = None
             proc = proc.prev
+        return (stdin, input)
 
-        (out, err) = sp.communicate(input)
-
-        sp.stdin = old_stdin
+    def _drain_stderr(self, pump):
+        """Collect the stderr of earlier commands in a pipe too, so they never
+           block writing to it"""
+        proc = self.prev if self.defer else None
+        while proc:
+            if proc.sp.stderr:
+                text = isinstance(proc.sp.stderr, io.TextIOBase)
+                pump.add_output(proc.sp.stderr, proc._sink('stderr', text), callback=False)
+            proc = proc.prev
 
-        returncodes = [sp.returncode]
-        proc = self.prev
+    def _processes(self, sp):
+        """The processes in a pipe that ends with this command, in order"""
+        processes = [sp]
+        proc = self.prev if self.defer else None
         while proc:
-            returncodes.insert(0, proc.sp.wait())
+            processes.insert(0, proc.sp)
             proc = proc.prev
-        res = Result(returncodes, out, err)
+        return processes
+
+    def _finish(self, sp, out, err, pump):
+        """Collect returncodes and resource usage of a finished process or
+           pipe and process the result"""
+        returncode = _reap(sp)
+        usage = Usage(sp, pump)
+        stage_stderr = None
+        if self.defer:
+            returncode = [returncode]
+            usage = [usage]
+            stage_stderr = [err]
+            proc = self.prev
+            while proc:
+                returncode.insert(0, _reap(proc.sp))
+                usage.insert(0, Usage(proc.sp, pump))
+                stage_stderr.insert(0, pump.value(proc.sp.stderr) if pump and proc.sp.stderr in pump.sinks else None)
+                proc = proc.prev
+        if pump and pump.timed_out:
+            raise subprocess.TimeoutExpired(sp.args, self.timeout, out, err)
+        return self._result(sp, returncode, out, err, usage, stage_stderr)
+
+    def _result(self, sp, returncode, out, err, usage=None, stage_stderr=None):
+        """Produce the result, process is None if it came from the cache"""
+        if sp and self.cache_key:
+            self.cache.put(self.cache_key, (returncode, out, err))
+        res = Result(returncode, out, err, usage, stage_stderr)
         if self.exit_callback:
             self.exit_callback[0](self, sp, res, *self.exit_callback[1:])
-        if self.raise_on_error and res.returncode.count(0) != len(res.returncode):
+        if self.raise_on_error and not res:
             raise CommandFailed(res)
         return res
 
-class ReaderThread:
-    def __init__(self, shell):
-        self.readfd, self.writefd = os.pipe()
-        if shell.encoding or shell.text:
-            self.readfd = os.fdopen(self.readfd, 'r', encoding=shell.encoding, errors=shell.errors)
-            self.writefd = os.fdopen(self.writefd, 'w', encoding=shell.encoding, errors=shell.errors)
+class PreparedCommand(object):
+    """A command whose keyword arguments have been processed and merged with
+       the defaults already. Calling it only needs to add the arguments and
+       input of that call. Other keyword arguments can be passed too, but
+       then all keyword arguments are processed again."""
+    def __init__(self, command, args, kwargs):
+        command._parse_args(args, kwargs)
+        self.command = command
+
+    def __call__(self, *args, **kwargs):
+        command = self.command
+        input = kwargs.pop('input', command.input)
+        if kwargs:
+            kwargs = dict(command.kwargs, input=input, **kwargs)
+            return copy.copy(command)(*(command.args + args), **kwargs)
+        return command._copy(args, input)._start()
+
+class PythonStage(Command):
+    """A command that runs a python function in a thread, so it can be used
+       in pipes without starting a process"""
+    def __init__(self, func, defer=False, defaults={}):
+        super(PythonStage, self).__init__(getattr(func, '__name__', repr(func)), defer, defaults)
+        self.func = func
+
+    def _parse_args(self, args, kwargs):
+        # Functions can have side effects, so never cache them
+        super(PythonStage, self)._parse_args(args, dict(kwargs, cache=None))
+
+    def _popen(self):
+        kwargs = self.sp_kwargs.copy()
+        opened = self._open_files(kwargs)
+        try:
+            if self.run_callback:
+                self.run_callback[0](self, *self.run_callback[1:])
+            sp = PythonProcess(self, kwargs)
+        finally:
+            for f in opened:
+                f.close()
+        sp.shell = self
+        if self.trace:
+            self.trace.spawned(self, sp)
+        return sp
+
+class Builtin(Command):
+    """A command that has a python implementation for its most common uses.
+       When called with only arguments and options that implementation
+       supports, it runs in this process and produces the same result the
+       real command would. Anything else, including use in pipes, runs the
+       real command."""
+    def __init__(self, name, func, defer=False, defaults={}):
+        super(Builtin, self).__init__(name, defer, defaults)
+        self.func = func
+
+    def _start(self):
+        if not self.defer and self.builtins:
+            res = self._run_builtin()
+            if res is not None:
+                return res
+        return super(Builtin, self)._start()
+
+    def _run_builtin(self):
+        """Run the python implementation, returns None if it can't be
+           used for this call"""
+        kwargs = self.sp_kwargs
+        if self.stream or self.background or self.output_callback or self.sinks or self.spill is not None:
+            return None
+        if self.affinity is not None or self.nice is not None or self.ionice is not None or self.rlimits:
+            return None
+        if kwargs.get('stdout') != PIPE or kwargs.get('stderr') != PIPE or set(kwargs) - _builtin_kwargs:
+            return None
+        text = self.encoding or self.errors or self.text or kwargs.get('universal_newlines')
+        encoding = (self.encoding or locale.getpreferredencoding(False)) if text else None
+        stdin = kwargs.get('stdin')
+        input = self.input or b''
+        if stdin == PIPE:
+            if isinstance(input, str) and text:
+                input = input.encode(encoding, self.errors or 'strict')
+            if _buffer(input) is None or isinstance(input, str):
+                return None
+            stdin = [bytes(input)]
+        elif not isinstance(stdin, (str, os.PathLike)):
+            return None
+        cwd = kwargs.get('cwd')
+        env = kwargs.get('env')
+        if env is None:
+            env = os.environ
+
+        def read(name):
+            if name == '-':
+                if isinstance(stdin, list):
+                    # Only the first reader gets the input, like with a pipe
+                    return stdin.pop() if stdin else b''
+                name = stdin
+            elif cwd:
+                name = os.path.join(cwd, name)
+            with open(name, 'rb') as fd:
+                return fd.read()
+
+        # Report the run before it happens, like for real commands. If the
+        # real command ends up running instead, it must not report it again.
+        (run_callback, self.run_callback) = (self.run_callback, None)
+        if run_callback:
+            run_callback[0](self, *run_callback[1:])
+        started = time.time()
+        try:
+            ret = self.func([str(arg) for arg in self.args], read, env)
+        except OSError:
+            # Let the real command complain about it
+            return None
+        if ret is None:
+            return None
+        (returncode, out) = ret
+        usage = Usage(None)
+        (usage.start, usage.end) = (started, time.time())
+        if self.trace:
+            self.trace.ran(self, usage.start, usage.end, returncode)
+        (usage.stdout, usage.stderr) = (len(out), 0)
+        if isinstance(stdin, list):
+            usage.stdin = len(input)
+        err = b''
+        if text:
+            out = _decoder(encoding, self.errors).decode(out, final=True)
+            err = ''
+        return self._result(None, returncode, out, err, usage)
+
+class Fanout(Command):
+    """A pipe stage that copies its input to multiple branches. The branches
+       are pipes themselves, whose first command gets the data. Data is
+       copied by a thread, which only reads more when all branches have
+       accepted the previous data, so slow branches slow down the producer
+       instead of filling up memory."""
+    def __init__(self, branches, defer=True, defaults={}):
+        super(Fanout, self).__init__('fanout', defer, defaults)
+        for branch in branches:
+            if not isinstance(branch, Command) or isinstance(branch, (AsyncCommand, Fanout)):
+                raise TypeError("Can only fan out to commands")
+            if not branch.defer or getattr(branch, 'next', True) or hasattr(branch, 'sp'):
+                raise ValueError("Command not chainable or already chained")
+            if not hasattr(branch, 'args'):
+                raise ValueError("Command not called yet")
+        self.branches = branches
+
+    def _parse_args(self, args, kwargs):
+        super(Fanout, self)._parse_args(args, kwargs)
+        if self.stream or self.background:
+            raise ValueError("Streaming and background jobs are not supported for fanout")
+
+    def __or__(self, other):
+        raise TypeError("Can't chain anything after a fanout, add it to a branch instead")
+
+    def _popen(self):
+        heads = []
+        for branch in self.branches:
+            branch.sp = branch._popen()
+            (stdin, input) = branch._pipe_input(branch.sp)
+            heads.append(stdin)
+        sp = FanoutProcess(self, self.sp_kwargs.get('stdin'), heads)
+        if self.trace:
+            self.trace.spawned(self, sp)
+        return sp
+
+    def run_pipe(self):
+        sp = self.sp = self._popen()
+        (stdin, input) = self._pipe_input(sp)
+        pump = IOPump(self, sp)
+        if stdin:
+            pump.add_input(stdin, input)
+        for branch in self.branches:
+            for stream in ('stdout', 'stderr'):
+                fileobj = getattr(branch.sp, stream)
+                if fileobj:
+                    pump.add_output(fileobj, branch._sink(stream, isinstance(fileobj, io.TextIOBase)))
+            branch._drain_stderr(pump)
+            pump.watch(branch._processes(branch.sp))
+        self._drain_stderr(pump)
+        pump.watch(self._processes(sp))
+        output = iter(pump.run())
+
+        # Returncodes of the commands before the fanout, followed by a list of
+        # them per branch
+        returncode, usage, stage_stderr = [], [], []
+        proc = self.prev
+        while proc:
+            returncode.insert(0, _reap(proc.sp))
+            usage.insert(0, Usage(proc.sp, pump))
+            stage_stderr.insert(0, pump.value(proc.sp.stderr) if proc.sp.stderr else None)
+            proc = proc.prev
+        _reap(sp)
+        out, err = [], []
+        for branch in self.branches:
+            out.append(next(output) if branch.sp.stdout else None)
+            err.append(next(output) if branch.sp.stderr else None)
+            codes, usages, errors = [], [], [err[-1]]
+            proc = branch
+            while proc:
+                codes.insert(0, _reap(proc.sp))
+                usages.insert(0, Usage(proc.sp, pump))
+                if proc is not branch:
+                    errors.insert(0, pump.value(proc.sp.stderr) if proc.sp.stderr else None)
+                proc = proc.prev
+            returncode.append(codes)
+            usage.append(usages)
+            stage_stderr.append(errors)
+        if pump.timed_out:
+            raise subprocess.TimeoutExpired(sp.args, self.timeout, out, err)
+        return self._result(sp, returncode, out, err, usage, stage_stderr)
+
+class FanoutProcess(object):
+    """Stand-in for a Popen object for the thread that copies data to the
+       branches of a fanout"""
+    pid = None
+
+    def __init__(self, command, stdin, heads):
+        self.args = ['fanout']
+        self.returncode = None
+        self.started = time.time()
+        self.stdout = self.stderr = self.stdin = None
+        if stdin == PIPE:
+            (reader, w) = os.pipe()
+            self.stdin = open(w, 'wb')
+        elif stdin in (None, DEVNULL) or isinstance(stdin, int):
+            reader = os.open(os.devnull, os.O_RDONLY) if stdin == DEVNULL else os.dup(0 if stdin is None else stdin)
         else:
-            self.readfd = os.fdopen(self.readfd, 'rb')
-            self.writefd = os.fdopen(self.writefd, 'wb')
-        self.shell = shell
-        self.callback = shell.output_callback[0]
-        self.args = shell.output_callback[1:]
-        self.process = None
-        self.thread = threading.Thread(target=self.reader)
-        self.output = b''
+            reader = os.dup(stdin.fileno())
+        self.read_size = command.read_size or IOPump.read_size
+        self.thread = threading.Thread(target=self._run, args=(reader, heads))
+        self.thread.daemon = True
         self.thread.start()
 
-    def set_process(self, process):
+    def _run(self, reader, heads):
+        heads = [head for head in heads if head]
+        try:
+            while heads:
+                data = os.read(reader, self.read_size)
+                if not data:
+                    break
+                for head in heads[:]:
+                    view = memoryview(data)
+                    try:
+                        while view:
+                            view = view[os.write(head.fileno(), view):]
+                    except BrokenPipeError:
+                        # This branch isn't interested in any more data
+                        heads.remove(head)
+                        self._close(head)
+        finally:
+            os.close(reader)
+            for head in heads:
+                self._close(head)
+            self.returncode = 0
+            self.ended = time.time()
+
+    def _close(self, fileobj):
+        try:
+            fileobj.close()
+        except BrokenPipeError:
+            pass
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+class PythonProcess(object):
+    """Stand-in for a Popen object for python stages. The function runs in a
+       thread, reading from and writing to pipes or files like a process
+       would. Its returncode is 0 if it succeeds, like that of a process
+       killed by SIGPIPE if its output is closed early, and 1 if it raises
+       an exception, which is then available as the exception attribute."""
+    pid = None
+
+    def __init__(self, command, kwargs):
+        self.args = [command.name] + list(command.args)
+        self.returncode = None
+        self.exception = None
+        self.started = time.time()
+        self.stdin = self.stdout = self.stderr = None
+        self.encoding = command.encoding
+        self.errors = command.errors
+        if self.encoding or self.errors or command.text or kwargs.get('universal_newlines'):
+            self.encoding = self.encoding or locale.getpreferredencoding(False)
+        if kwargs.get('stdin') == PIPE:
+            (reader, w) = os.pipe()
+            self.stdin = self._open(w, 'wb')
+        else:
+            reader = self._dup(kwargs.get('stdin'), 0)
+        if kwargs.get('stdout') == PIPE:
+            (r, writer) = os.pipe()
+            self.stdout = self._open(r, 'rb')
+        else:
+            writer = self._dup(kwargs.get('stdout'), 1)
+        self.thread = threading.Thread(target=self._run, args=(command, self._open(reader, 'rb'), self._open(writer, 'wb')))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _open(self, fd, mode):
+        f = open(fd, mode)
+        if self.encoding:
+            f = io.TextIOWrapper(f, encoding=self.encoding, errors=self.errors)
+        return f
+
+    def _dup(self, target, default):
+        """A file descriptor of our own for a stdin or stdout target, so it
+           stays usable when the caller closes theirs"""
+        if target is None:
+            return os.dup(default)
+        if target == DEVNULL:
+            return os.open(os.devnull, os.O_RDWR)
+        if isinstance(target, int):
+            return os.dup(target)
+        return os.dup(target.fileno())
+
+    def _run(self, command, reader, writer):
+        try:
+            try:
+                output = command.func(reader, *command.args)
+                if isinstance(output, str) or _buffer(output) is not None:
+                    writer.write(output)
+                elif output is not None:
+                    for data in output:
+                        writer.write(data)
+            finally:
+                reader.close()
+                writer.close()
+            self.returncode = 0
+        except BrokenPipeError:
+            self.returncode = -signal.SIGPIPE
+        except BaseException as e:
+            self.exception = e
+            self.returncode = 1
+        finally:
+            self.ended = time.time()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+class AsyncCommand(Command):
+    """Command that runs its process with asyncio. Calling it returns a
+       coroutine that produces the result."""
+    def _start(self):
+        if self.stream:
+            raise ValueError("Streaming is not supported for async commands")
+        if self.background:
+            raise ValueError("Background jobs are not supported for async commands, use tasks instead")
+        if not self.defer:
+            return self._run()
+        self.next = self.prev = None
+        return self
+
+    def __or__(self, other):
+        """Chain processes together. They are all started when the pipe is
+           awaited"""
+        self._chain(other)
+        return other
+
+    async def _spawn(self, **kwargs):
+        """Start the process, asyncio does not support text mode so that
+           is handled by _communicate"""
+        import asyncio
+        sp_kwargs = self.sp_kwargs.copy()
+        for kwarg in ('encoding', 'errors', 'text', 'universal_newlines'):
+            sp_kwargs.pop(kwarg, None)
+        sp_kwargs.update(kwargs)
+        opened = self._open_files(sp_kwargs)
+        self._limit(sp_kwargs)
+        try:
+            if self.run_callback:
+                self.run_callback[0](self, *self.run_callback[1:])
+            started = time.time()
+            self.sp = await asyncio.create_subprocess_exec(str(self.name), *[str(x) for x in self.args], **sp_kwargs)
+        finally:
+            for f in opened:
+                f.close()
+        self.sp.shell = self
+        self.sp.started = started
+        if self.trace:
+            self.trace.spawned(self, self.sp)
+        return self.sp
+
+    async def _wait(self, sp):
+        returncode = await sp.wait()
+        if not hasattr(sp, 'ended'):
+            sp.ended = time.time()
+            if self.trace:
+                self.trace.exited(sp)
+        return returncode
+
+    async def _run(self):
+        if self.cache_key:
+            cached = self.cache.get(self.cache_key)
+            if cached:
+                return self._result(None, *cached)
+        sp = await self._spawn()
+        async def finish():
+            (out, err) = await self._communicate(sp, sp.stdin, self.input)
+            return (await self._wait(sp), out, err)
+        return self._result(sp, *await self._within_timeout([sp], finish()))
+
+    async def run_pipe(self):
+        """Start all processes in the pipe, connected with os-level pipes,
+           and collect the output of the last one."""
+        commands = []
+        cmd = self
+        while cmd:
+            commands.insert(0, cmd)
+            cmd = cmd.prev
+        stdin = None
+        for cmd in commands:
+            kwargs = {}
+            if cmd is not commands[0]:
+                kwargs['stdin'] = stdin
+            if cmd is not self:
+                stdin, kwargs['stdout'] = os.pipe()
+                cmd.sinks.pop('stdout', None)
+                if cmd.sp_kwargs.get('stderr') == PIPE:
+                    # Nobody reads this
+                    kwargs['stderr'] = DEVNULL
+            try:
+                await cmd._spawn(**kwargs)
+            finally:
+                if 'stdin' in kwargs:
+                    os.close(kwargs['stdin'])
+                if 'stdout' in kwargs:
+                    os.close(kwargs['stdout'])
+        async def finish():
+            (out, err) = await self._communicate(self.sp, commands[0].sp.stdin, commands[0].input)
+            return ([await cmd._wait(cmd.sp) for cmd in commands], out, err)
+        return self._result(self.sp, *await self._within_timeout([cmd.sp for cmd in commands], finish()))
+
+    async def _within_timeout(self, processes, coro):
+        """Run coro, killing all processes and raising TimeoutExpired when
+           the command's timeout expires first"""
+        import asyncio
+        if self.timeout is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+            for process in processes:
+                await self._wait(process)
+            raise subprocess.TimeoutExpired([str(self.name)] + [str(arg) for arg in self.args], self.timeout)
+
+    async def _communicate(self, sp, stdin, input):
+        """Feed input to stdin and read stdout and stderr of sp, all at the
+           same time"""
+        import asyncio
+        encoding = self.encoding
+        text = encoding or self.errors or self.text or self.sp_kwargs.get('universal_newlines')
+        if text:
+            encoding = encoding or locale.getpreferredencoding(False)
+        read_size = self.read_size or IOPump.read_size
+        callback = self.output_callback
+        trace = self.trace
+
+        def encode(data):
+            if isinstance(data, str) and text:
+                return data.encode(encoding, self.errors or 'strict')
+            return data
+
+        async def write():
+            source = None
+            data = input
+            if _is_source(data):
+                source = _input_chunks(data, read_size)
+                data = next(source, None)
+            try:
+                while data:
+                    stdin.write(encode(data))
+                    await stdin.drain()
+                    data = source and next(source, None)
+            except (BrokenPipeError, ConnectionResetError):
+                # The process isn't interested in any more input
+                pass
+            stdin.close()
+            if trace:
+                trace.closed(stdin)
+
+        async def read(stream, sink):
+            decoder = _decoder(encoding, self.errors) if text and not (sink and sink.buffer) else None
+            chunks = []
+            while True:
+                data = await stream.read(read_size)
+                eof = not data
+                if trace and data:
+                    trace.output(stream)
+                if decoder:
+                    data = decoder.decode(data, final=eof)
+                if data:
+                    if callback:
+                        callback[0](self, sp, stream, data, *callback[1:])
+                    if sink:
+                        sink.write(data)
+                    else:
+                        chunks.append(data)
+                if eof:
+                    break
+            if callback:
+                callback[0](self, sp, stream, None, *callback[1:])
+            if sink:
+                return sink.value()
+            return ('' if decoder else b'').join(chunks)
+
+        async def nothing():
+            return None
+
+        (_, out, err) = await asyncio.gather(
+            write() if stdin else nothing(),
+            read(sp.stdout, self._sink('stdout', text)) if sp.stdout else nothing(),
+            read(sp.stderr, self._sink('stderr', text)) if sp.stderr else nothing(),
+        )
+        return (out, err)
+
+class IOPump(object):
+    """Feeds input to a process and collects its output. Instead of using a
+       thread per stream, stdin, stdout and stderr are all serviced from a
+       single selector loop. The same loop notices when processes exit, and
+       tears everything down when the command's timeout expires."""
+    read_size = 65536
+    poll_interval = 0.05
+    # How long processes before a failed one get to exit by themselves
+    grace_period = 0.1
+
+    def __init__(self, command, process, selector=None):
+        self.command = command
         self.process = process
-        self.writefd.close()
+        self.read_size = command.read_size or self.read_size
+        # Background jobs share a selector
+        self.selector = selector or selectors.DefaultSelector()
+        self.outputs = []
+        self.chunks = {}
+        self.sinks = {}
+        self.silent = set()
+        self.registered = []
+        # Number of bytes written to or read from each file object
+        self.transferred = {}
+        # Watched processes, their pidfds and the pipes they are part of
+        self.pidfds = {}
+        self.polled = []
+        self.pipes = {}
+        # Processes that get SIGPIPE when their grace period ends
+        self.doomed = []
+        self.doom = None
+        self.trace = getattr(command, 'trace', None)
+        timeout = getattr(command, 'timeout', None)
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.timed_out = False
 
-    def reader(self):
-        while True:
-            data = self.readfd.read(100)
-            if data == b'':
-                data = None
-            self.callback(self.shell, self.process, self.readfd, data, *self.args)
-            if not data:
+    def add_input(self, fileobj, data):
+        """Write data to fileobj and close it when done. Data can be a
+           string, anything that supports the buffer protocol, a file-like
+           object to read data from or an iterable of strings or bytes. The
+           latter two are only read from when fileobj can accept more
+           data."""
+        source = None
+        if _is_source(data):
+            source = _input_chunks(data, self.read_size)
+            data = next(source, None)
+        data = self._encode(fileobj, data)
+        if not data:
+            fileobj.close()
+            if self.trace:
+                self.trace.closed(fileobj)
+            return
+        view = _buffer(data)
+        if view is None:
+            raise TypeError("Can't use %r as input" % data)
+        os.set_blocking(fileobj.fileno(), False)
+        self.selector.register(fileobj, selectors.EVENT_WRITE, [view, 0, source])
+        self.registered.append(fileobj)
+
+    def _encode(self, fileobj, data):
+        if isinstance(data, str) and isinstance(fileobj, io.TextIOBase):
+            data = data.encode(fileobj.encoding, fileobj.errors or 'strict')
+        return data
+
+    def add_output(self, fileobj, sink=None, callback=True):
+        """Read data from fileobj, decoding it if it's a text stream. If a
+           sink is given, data is written to that instead of being
+           collected. Without callback, the command's output callback is not
+           called for it."""
+        decoder = None
+        if isinstance(fileobj, io.TextIOBase) and not (sink and sink.buffer):
+            decoder = _decoder(fileobj.encoding, fileobj.errors)
+        self.outputs.append((fileobj, sink))
+        self.chunks[fileobj] = []
+        self.sinks[fileobj] = sink
+        if not callback:
+            self.silent.add(fileobj)
+        self.selector.register(fileobj, selectors.EVENT_READ, (decoder, sink))
+        self.registered.append(fileobj)
+
+    def watch(self, processes):
+        """Watch the processes of a pipe, given in order. When one of them
+           fails, or is killed by SIGPIPE itself, the output of the ones
+           before it is of no use anymore. Those that are still running after
+           a short grace period are killed with SIGPIPE, as if they had
+           written to the closed pipe.
+           Processes that exit successfully may not have read all their input,
+           like head, so their producers get SIGPIPE when they write more, as
+           usual. Exits are noticed with pidfds where the platform supports
+           them, other processes are polled."""
+        for process in processes:
+            self.pipes[process] = processes
+            if not process.pid or process.returncode is not None:
+                continue
+            pidfd = _pidfd(process)
+            if pidfd is None:
+                self.polled.append(process)
+            else:
+                process.pidfd = pidfd
+                self.pidfds[pidfd] = process
+                self.selector.register(pidfd, selectors.EVENT_READ)
+
+    def _exited(self, process):
+        if not _poll(process):
+            return
+        process.ended = time.time()
+        if process.returncode != 0:
+            pipe = self.pipes[process]
+            self.doomed.extend(pipe[:pipe.index(process)])
+            if self.doom is None:
+                self.doom = time.monotonic() + self.grace_period
+
+    def _kill_doomed(self):
+        if self.doom is not None and time.monotonic() >= self.doom:
+            for process in self.doomed:
+                self._signal(process, signal.SIGPIPE)
+            self.doomed = []
+            self.doom = None
+
+    def _signal(self, process, signum):
+        if not process.pid or process.returncode is not None:
+            return
+        pidfd = getattr(process, 'pidfd', None)
+        try:
+            if pidfd in self.pidfds and hasattr(signal, 'pidfd_send_signal'):
+                # No risk of signalling a new process that reused the pid
+                signal.pidfd_send_signal(pidfd, signum)
+            else:
+                process.send_signal(signum)
+        except ProcessLookupError:
+            pass
+
+    def _orphaned(self):
+        """When all processes of a pipe have exited, and only the stderr of
+           earlier processes is still open, those are only read until
+           there's nothing left in them"""
+        if not self.pipes or self.pidfds or self.polled:
+            return None
+        keys = list(self.selector.get_map().values())
+        if all(key.fileobj in self.silent for key in keys):
+            return keys
+        return None
+
+    def _select_timeout(self):
+        timeouts = []
+        if self.polled:
+            timeouts.append(self.poll_interval)
+        if self.deadline is not None and not self.timed_out:
+            timeouts.append(max(0, self.deadline - time.monotonic()))
+        if self.doom is not None:
+            timeouts.append(max(0, self.doom - time.monotonic()))
+        return min(timeouts) if timeouts else None
+
+    def _expire(self):
+        """Kill all watched processes and stop reading and writing, the
+           timeout has expired"""
+        self.timed_out = True
+        for process in self.pipes:
+            self._signal(process, signal.SIGKILL)
+        for key in list(self.selector.get_map().values()):
+            if key.fd not in self.pidfds:
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+    def events(self):
+        """Generates (fileobj, data) tuples as output arrives. data is None
+           when fileobj reaches EOF."""
+        try:
+            while self.selector.get_map():
+                orphaned = self._orphaned()
+                ready = self.selector.select(0 if orphaned else self._select_timeout())
+                for key, mask in ready:
+                    for event in self.handle(key, mask):
+                        yield event
+                if orphaned and not ready:
+                    # Processes that the pipe's processes left behind may
+                    # keep these open, but nobody waits for them
+                    for key in orphaned:
+                        self.selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        yield key.fileobj, None
+                for process in list(self.polled):
+                    if _poll(process):
+                        self.polled.remove(process)
+                        self._exited(process)
+                self._kill_doomed()
+                if self.deadline is not None and not self.timed_out and time.monotonic() >= self.deadline:
+                    self._expire()
+        finally:
+            for key in list(self.selector.get_map().values()):
+                self.selector.unregister(key.fileobj)
+                if key.fd in self.pidfds:
+                    os.close(key.fd)
+                else:
+                    key.fileobj.close()
+            self.selector.close()
+
+    def handle(self, key, mask):
+        """Service a single ready file object, generates the same events as
+           the events method"""
+        if key.fd in self.pidfds:
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+            self._exited(self.pidfds.pop(key.fd))
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._write(key)
+            return
+        decoder, sink = key.data
+        if sink and sink.buffer:
+            # Read straight into the buffer, until it's full
+            data = sink.readinto(key.fd, self.read_size)
+        else:
+            data = os.read(key.fd, self.read_size)
+        self.transferred[key.fileobj] = self.transferred.get(key.fileobj, 0) + len(data)
+        if self.trace and data:
+            self.trace.output(key.fileobj)
+        if decoder:
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield key.fileobj, text
+        elif data:
+            yield key.fileobj, data
+        if not data:
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+            yield key.fileobj, None
+
+    def _write(self, key):
+        view, offset, source = key.data
+        try:
+            written = os.write(key.fd, view[offset:])
+            offset += written
+            self.transferred[key.fileobj] = self.transferred.get(key.fileobj, 0) + written
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            # The process isn't interested in any more input
+            offset = len(view)
+            source = None
+        key.data[1] = offset
+        if offset == len(view) and source:
+            data = self._encode(key.fileobj, next(source, None))
+            if data:
+                key.data[:2] = [_buffer(data), 0]
+                return
+        if offset == len(view):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+            if self.trace:
+                self.trace.closed(key.fileobj)
+
+    def run(self):
+        """Run the loop until all streams are closed, and return the collected
+           output of all output streams"""
+        for fileobj, data in self.events():
+            self.collect(fileobj, data)
+        return self.output()
+
+    def collect(self, fileobj, data):
+        """Pass an event to the output callback and collect its data"""
+        callback = self.command.output_callback
+        if callback and fileobj not in self.silent:
+            callback[0](self.command, self.process, fileobj, data, *callback[1:])
+        if data is None:
+            return
+        sink = self.sinks[fileobj]
+        if not sink:
+            self.chunks[fileobj].append(data)
+        elif not sink.buffer:
+            sink.write(data)
+
+    def output(self):
+        """The collected output of all output streams"""
+        return [self.value(fileobj) for (fileobj, sink) in self.outputs if fileobj not in self.silent]
+
+    def value(self, fileobj):
+        """The collected output of a single output stream"""
+        sink = self.sinks[fileobj]
+        if sink:
+            return sink.value()
+        if isinstance(fileobj, io.TextIOBase):
+            return ''.join(self.chunks[fileobj])
+        return b''.join(self.chunks[fileobj])
+
+    def communicate(self, stdin, input):
+        """Replacement for Popen.communicate. Input is sent to stdin, which
+           need not be the stdin of the process itself."""
+        process = self.process
+        if sys.platform == 'win32':
+            # Pipes can't be selected on windows, so let subprocess deal with
+            # it and do all the callbacks at the end.
+            process.stdin, old_stdin = stdin, process.stdin
+            if _is_source(input):
+                input = _join(list(_input_chunks(input, self.read_size)))
+            (out, err) = process.communicate(input)
+            process.stdin = old_stdin
+            callback = self.command.output_callback
+            if callback:
+                for fileobj, data in ((process.stdout, out), (process.stderr, err)):
+                    if fileobj:
+                        if data:
+                            callback[0](self.command, process, fileobj, data, *callback[1:])
+                        callback[0](self.command, process, fileobj, None, *callback[1:])
+            return (out, err)
+        if stdin:
+            self.add_input(stdin, input)
+        if process.stdout:
+            self.add_output(process.stdout, self.command._sink('stdout', isinstance(process.stdout, io.TextIOBase)))
+        if process.stderr:
+            self.add_output(process.stderr, self.command._sink('stderr', isinstance(process.stderr, io.TextIOBase)))
+        output = iter(self.run())
+        out = next(output) if process.stdout else None
+        err = next(output) if process.stderr else None
+        _reap(process)
+        return (out, err)
+
+class AsyncShell(Shell):
+    """Shell subclass whose commands run with asyncio, calling them returns a
+       coroutine"""
+    command_class = AsyncCommand
+
+    async def map(self, cmd, argsets, max_workers=None, ordered=True, fail_fast=False, **kwargs):
+        """Like Shell.map, but as an asynchronous generator"""
+        async for res in self._map(self.prepare(cmd, defer=False, **kwargs), argsets, max_workers, ordered, fail_fast):
+            yield res
+
+    async def _map(self, command, argsets, max_workers, ordered, fail_fast):
+        import asyncio
+        semaphore = asyncio.Semaphore(max_workers or os.cpu_count())
+        failed = []
+        async def run(args):
+            async with semaphore:
+                if failed:
+                    # Skipped, passed over below
+                    return None
+                try:
+                    res = await command(*args)
+                except CommandFailed:
+                    if fail_fast:
+                        failed.append(True)
+                    raise
+                if not res and fail_fast:
+                    failed.append(True)
+                return res
+        tasks = [asyncio.ensure_future(run(_argset(args))) for args in argsets]
+        try:
+            for task in (tasks if ordered else asyncio.as_completed(tasks)):
+                res = await task
+                if res is None:
+                    continue
+                if fail_fast and not res:
+                    raise CommandFailed(res)
+                yield res
+        finally:
+            # Commands that are running are allowed to finish, others won't
+            # be started.
+            failed.append(True)
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def batched(self, cmd, args, initial=(), max_workers=None, max_args=None, fail_fast=False, **kwargs):
+        """Like Shell.batched, but as a coroutine"""
+        command = self.prepare(cmd, *initial, defer=False, **kwargs)
+        batches = _batches(command.command, args, max_args)
+        targets = _redirect(command.command)
+        return _combined(command.command, [res async for res in self._map(command, batches, max_workers, True, fail_fast)], targets)
+
+class AsyncPipe(Pipe):
+    """Pipe subclass whose pipes run with asyncio, calling it returns a
+       coroutine"""
+    command_class = AsyncCommand
+
+class SpawnPopen(Popen):
+    """Popen subclass that starts the process with os.posix_spawn, so the
+       cost of starting a process does not depend on the size of the parent.
+       Like close_fds, all inheritable file descriptors other than stdin,
+       stdout and stderr are closed in the child."""
+    def _execute_child(self, args, executable, preexec_fn, close_fds, pass_fds,
+                       cwd, env, startupinfo, creationflags, shell,
+                       p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite,
+                       restore_signals, *rest):
+        # dup2 does not clear the close-on-exec flag when a descriptor is
+        # duplicated onto itself, let subprocess deal with such cases
+        if any(0 <= fd <= 2 for fd in (p2cread, c2pwrite, errwrite)):
+            return super(SpawnPopen, self)._execute_child(args, executable, preexec_fn, close_fds, pass_fds,
+                cwd, env, startupinfo, creationflags, shell, p2cread, p2cwrite, c2pread, c2pwrite,
+                errread, errwrite, restore_signals, *rest)
+        args = list(args)
+        executable = executable or args[0]
+        sys.audit("subprocess.Popen", executable, args, cwd, env)
+        kwargs = {}
+        if restore_signals:
+            kwargs['setsigdef'] = [getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name)]
+        file_actions = []
+        for fd, target in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2)):
+            if fd != -1:
+                file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+        for fd in _inheritable_fds():
+            file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+        kwargs['file_actions'] = file_actions
+        self.pid = os.posix_spawn(executable, args, os.environ if env is None else env, **kwargs)
+        self._child_created = True
+        self._close_pipe_fds(p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite)
+
+def _can_spawn(kwargs, method):
+    """Whether a process with these Popen arguments can be started with
+       os.posix_spawn or the spawn server. Neither can change users or
+       sessions or run arbitrary python code in the child, and os.posix_spawn
+       can't change directories or apply limits either."""
+    if method == 'fork' or not hasattr(os, 'posix_spawn'):
+        return False
+    if method == 'posix_spawn' and kwargs.get('cwd'):
+        return False
+    if kwargs.get('shell') or kwargs.get('executable'):
+        return False
+    # The spawn server applies limits itself
+    preexec_fn = kwargs.get('preexec_fn')
+    if preexec_fn and not (method == 'server' and isinstance(preexec_fn, Limits) and not preexec_fn.preexec_fn):
+        return False
+    for kwarg in ('pass_fds', 'start_new_session', 'user', 'group', 'extra_groups'):
+        if kwargs.get(kwarg):
+            return False
+    return kwargs.get('umask', -1) < 0 and kwargs.get('process_group') is None
+
+def _inheritable_fds():
+    """File descriptors above 2 that would be inherited by a child process"""
+    fds = []
+    for fd in os.listdir('/proc/self/fd' if os.path.isdir('/proc/self/fd') else '/dev/fd'):
+        fd = int(fd)
+        if fd <= 2:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                fds.append(fd)
+        except OSError:
+            # The descriptor used for listing the directory
+            pass
+    return fds
+
+class SpawnServer(object):
+    """A helper process that starts processes on behalf of this one. It is
+       a fresh, single-threaded python interpreter, so starting processes from
+       it is cheap and safe, no matter how big or multi-threaded this process
+       is. Requests are sent over a
+       unix socket, together with the file descriptors for the new process.
+       The server is started when it is first needed, or when start() is
+       called, and stopped when this process exits."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.sock = None
+        self.registered = False
+        # Forked copies of this process must not keep the server's socket
+        # open, or the server can't see that we stopped it
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self.lock = threading.Lock()
+        if self.sock:
+            self.sock.close()
+            # The server is not our child, nothing to wait for
+            self.process._child_created = False
+        self.sock = self.process = None
+
+    def start(self):
+        """Start the server if it isn't running yet"""
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        if self.sock and self.process.poll() is None:
+            return
+        if self.sock:
+            # The server died, start a new one
+            self.sock.close()
+        sock, server_sock = socket.socketpair()
+        code = 'import sys; sys.path.insert(0, %r); import whelk; whelk._serve_spawns(%d)' % (
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), server_sock.fileno())
+        try:
+            self.process = Popen([sys.executable, '-c', code], stdin=DEVNULL, pass_fds=[server_sock.fileno()])
+        finally:
+            server_sock.close()
+        self.sock = sock
+        if not self.registered:
+            # Forked copies inherit this, and stop a server they started
+            atexit.register(self.stop)
+            self.registered = True
+
+    def stop(self):
+        """Stop the server. Processes it started keep running."""
+        with self.lock:
+            if self.sock:
+                self.sock.close()
+                try:
+                    self.process.wait(1)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.sock = None
+
+    def spawn(self, request, fds):
+        """Have the server start a process, returns its pid"""
+        data = pickle.dumps(request)
+        data = struct.pack('=I', len(data)) + data
+        with self.lock:
+            self._start()
+            sent = socket.send_fds(self.sock, [data], fds)
+            self.sock.sendall(data[sent:])
+            (pid, errno, failed) = struct.unpack('=iiB', _recv_exactly(self.sock, struct.calcsize('=iiB')))
+        if errno and failed == _FAILED_LIMITS:
+            raise OSError(errno, "Can't apply limits: %s" % os.strerror(errno))
+        if errno:
+            raise OSError(errno, os.strerror(errno), request['cwd' if failed == _FAILED_CWD else 'executable'])
+        return pid
+
+class ServerPopen(Popen):
+    """Popen subclass that has its process started by the spawn server. As
+       the process is not our child, its exit status and resource usage are
+       sent back by the server over a pipe."""
+    status_format = '=i2d14q'
+
+    def _execute_child(self, args, executable, preexec_fn, close_fds, pass_fds,
+                       cwd, env, startupinfo, creationflags, shell,
+                       p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite,
+                       restore_signals, *rest):
+        args = list(args)
+        executable = executable or args[0]
+        sys.audit("subprocess.Popen", executable, args, cwd, env)
+        request = {
+            'args': [os.fspath(arg) for arg in args],
+            'executable': os.fspath(executable),
+            # The server does not follow our working directory or environment
+            'cwd': os.path.join(os.getcwd(), os.fsdecode(cwd) if cwd is not None else ''),
+            'env': dict(os.environ if env is None else env),
+            'restore_signals': restore_signals,
+            'limits': preexec_fn,
+        }
+        # Without redirection, the process gets our stdin, stdout and stderr
+        fds = [fd if fd != -1 else i for (i, fd) in enumerate((p2cread, c2pwrite, errwrite))]
+        self.status, status_w = os.pipe()
+        try:
+            self.pid = spawn_server.spawn(request, fds + [status_w])
+        except:
+            os.close(self.status)
+            raise
+        finally:
+            os.close(status_w)
+        self._child_created = True
+        self._close_pipe_fds(p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite)
+
+    def _read_status(self):
+        data = b''
+        size = struct.calcsize(self.status_format)
+        while len(data) < size:
+            chunk = os.read(self.status, size - len(data))
+            if not chunk:
                 break
-            self.output += data
-        self.readfd.close()
+            data += chunk
+        os.close(self.status)
+        self.ended = time.time()
+        if len(data) < size:
+            raise ChildProcessError("The spawn server exited before process %d did" % self.pid)
+        status = struct.unpack(self.status_format, data)
+        import resource
+        self.rusage = resource.struct_rusage(status[1:])
+        self.returncode = os.waitstatus_to_exitcode(status[0])
+
+    def _wait(self, timeout):
+        if self.returncode is not None:
+            return self.returncode
+        if timeout is not None and not select.select([self.status], [], [], timeout)[0]:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        with self._waitpid_lock:
+            if self.returncode is None:
+                self._read_status()
+        return self.returncode
+
+    def _internal_poll(self, _deadstate=None, **kwargs):
+        if self.returncode is None and self._waitpid_lock.acquire(False):
+            try:
+                if self.returncode is None and select.select([self.status], [], [], 0)[0]:
+                    self._read_status()
+            finally:
+                self._waitpid_lock.release()
+        return self.returncode
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return data
+
+def _serve_spawns(fd):
+    """Main loop of the spawn server. It starts processes when asked to, and
+       reports their exit status when they exit. It stops when the socket is
+       closed."""
+    sock = socket.socket(fileno=fd)
+    sock.set_inheritable(False)
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(wakeup_r, selectors.EVENT_READ)
+    children = {}
+    while True:
+        for key, mask in selector.select():
+            if key.fileobj is not sock:
+                while True:
+                    try:
+                        os.read(wakeup_r, 4096)
+                    except BlockingIOError:
+                        break
+                continue
+            try:
+                (header, fds, flags, addr) = socket.recv_fds(sock, 4, 4)
+                if not header:
+                    return
+                header += _recv_exactly(sock, 4 - len(header))
+                request = pickle.loads(_recv_exactly(sock, struct.unpack('=I', header)[0]))
+            except EOFError:
+                return
+            try:
+                (pid, errno, failed) = _serve_spawn(request, fds)
+            finally:
+                for f in fds[:3]:
+                    os.close(f)
+            if errno:
+                os.close(fds[3])
+            else:
+                children[pid] = fds[3]
+            sock.sendall(struct.pack('=iiB', pid, errno, failed))
+        while children:
+            (pid, status, rusage) = os.wait4(-1, os.WNOHANG)
+            if not pid:
+                break
+            status_w = children.pop(pid, None)
+            if status_w is not None:
+                os.write(status_w, struct.pack(ServerPopen.status_format, status, *rusage))
+                os.close(status_w)
+
+# Why the spawn server could not start a process
+(_FAILED_EXEC, _FAILED_CWD, _FAILED_LIMITS) = range(3)
+
+def _serve_spawn(request, fds):
+    """Start a process for the spawn server. Returns the pid, an errno which
+       is non-zero when the process couldn't be started and what failed. The
+       server does nothing else, so it can change directories for the new
+       process."""
+    try:
+        os.chdir(request['cwd'])
+    except OSError as e:
+        return (0, e.errno or 0, _FAILED_CWD)
+    if request['limits']:
+        return _serve_fork(request, fds)
+    kwargs = {}
+    if request['restore_signals']:
+        kwargs['setsigdef'] = [getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name)]
+    file_actions = [(os.POSIX_SPAWN_DUP2, f, i) for (i, f) in enumerate(fds[:3])]
+    file_actions += [(os.POSIX_SPAWN_CLOSE, f) for f in fds]
+    try:
+        return (os.posix_spawnp(request['executable'], request['args'], request['env'],
+                                file_actions=file_actions, **kwargs), 0, _FAILED_EXEC)
+    except OSError as e:
+        return (0, e.errno or 0, _FAILED_EXEC)
+
+def _serve_fork(request, fds):
+    """Start a process that needs to apply limits to itself before running
+       its command. os.posix_spawn can't do that, but the server is small and
+       single-threaded, so it can safely fork and do it in the child."""
+    errpipe_r, errpipe_w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        failed = _FAILED_LIMITS
+        try:
+            request['limits']()
+            failed = _FAILED_EXEC
+            for (i, f) in enumerate(fds[:3]):
+                os.dup2(f, i)
+            for f in fds:
+                os.close(f)
+            if request['restore_signals']:
+                for name in ('SIGPIPE', 'SIGXFSZ'):
+                    if hasattr(signal, name):
+                        signal.signal(getattr(signal, name), signal.SIG_DFL)
+            os.execvpe(request['executable'], request['args'], request['env'])
+        except BaseException as e:
+            os.write(errpipe_w, struct.pack('=iB', getattr(e, 'errno', None) or errno.EINVAL, failed))
+        finally:
+            os._exit(255)
+    os.close(errpipe_w)
+    data = b''
+    while True:
+        chunk = os.read(errpipe_r, 16)
+        if not chunk:
+            break
+        data += chunk
+    os.close(errpipe_r)
+    if not data:
+        return (pid, 0, _FAILED_EXEC)
+    os.waitpid(pid, 0)
+    return (0,) + struct.unpack('=iB', data)
+
+class Usage(object):
+    """Resource usage of a single process. Wall clock start and end times
+       are in seconds since the epoch, cpu times in seconds and the maximum
+       resident set size in bytes. stdin, stdout and stderr are the number of
+       bytes whelk wrote to or read from the process, or None if whelk did not
+       do so, for example because it was connected to a file or another
+       process. Anything that can't be measured on this platform is None."""
+    def __init__(self, process, pump=None):
+        self.start = getattr(process, 'started', None)
+        self.end = getattr(process, 'ended', None)
+        rusage = getattr(process, 'rusage', None)
+        self.utime = rusage and rusage.ru_utime
+        self.stime = rusage and rusage.ru_stime
+        # Linux reports kilobytes, macOS reports bytes
+        self.maxrss = rusage and rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        transferred = pump.transferred if pump else {}
+        self.stdin = transferred.get(process.stdin) if getattr(process, 'stdin', None) else None
+        self.stdout = transferred.get(process.stdout) if getattr(process, 'stdout', None) else None
+        self.stderr = transferred.get(process.stderr) if getattr(process, 'stderr', None) else None
+
+    wall = property(lambda self: None if self.end is None else self.end - self.start)
+
+    def __repr__(self):
+        return 'Usage(%s)' % ', '.join('%s=%r' % (attr, getattr(self, attr))
+            for attr in ('wall', 'utime', 'stime', 'maxrss', 'stdin', 'stdout', 'stderr'))
+
+class Trace(object):
+    """A timeline of the processes whelk runs, to find out where the time of
+       a long program run goes. For every process, including all stages of a
+       pipe, it records when it was started, when whelk first read from its
+       stdout and stderr, when whelk closed its stdin and when it exited, with
+       its pid, arguments and returncode. Python stages and fanouts are recorded
+       like processes, builtins as a single event.
+
+       Events are kept in memory and written in the Chrome trace event format,
+       which Perfetto and chrome://tracing can show. Used as a context
+       manager, the trace is written to path at the end of the block."""
+    def __init__(self, path=None):
+        self.path = path
+        self.pid = os.getpid()
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.events = []
+        # Running processes, with their track and the streams that haven't
+        # been read from or closed yet
+        self.running = {}
+        self.streams = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.path:
+            self.write()
+
+    def _ts(self, when):
+        """Timestamps are in microseconds since the trace was created"""
+        return round((when - self.start) * 1e6, 3)
+
+    def spawned(self, command, process):
+        """Record the start of a process"""
+        track = process.pid or id(process)
+        argv = [str(command.name)] + [str(arg) for arg in command.args]
+        name = os.path.basename(argv[0])
+        streams = [stream for stream in (process.stdin, process.stdout, process.stderr) if stream is not None]
+        process.trace = self
+        with self.lock:
+            self.running[process] = (track, streams)
+            for (kind, stream) in zip(('stdin', 'stdout', 'stderr'), (process.stdin, process.stdout, process.stderr)):
+                if stream is not None:
+                    self.streams[stream] = (track, kind)
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': track,
+                                'args': {'name': '%s (%s)' % (name, process.pid or 'thread')}})
+            self.events.append({'name': name, 'cat': 'process' if process.pid else 'thread', 'ph': 'B',
+                                'ts': self._ts(getattr(process, 'started', None) or time.time()), 'pid': self.pid, 'tid': track,
+                                'args': {'argv': argv, 'pid': process.pid}})
+
+    def output(self, stream):
+        """Record the first output read from a stream, later calls for the
+           same stream are ignored"""
+        self._instant(stream, 'first %s')
+
+    def closed(self, stream):
+        """Record that the stdin of a process was closed"""
+        self._instant(stream, '%s closed')
+
+    def _instant(self, stream, name):
+        with self.lock:
+            entry = self.streams.pop(stream, None)
+            if entry:
+                self.events.append({'name': name % entry[1], 'ph': 'i', 's': 't', 'ts': self._ts(time.time()),
+                                    'pid': self.pid, 'tid': entry[0]})
+
+    def exited(self, process):
+        """Record the exit of a process, this can safely be called more than
+           once"""
+        with self.lock:
+            entry = self.running.pop(process, None)
+            if not entry:
+                return
+            for stream in entry[1]:
+                self.streams.pop(stream, None)
+            self.events.append({'ph': 'E', 'ts': self._ts(getattr(process, 'ended', None) or time.time()),
+                                'pid': self.pid, 'tid': entry[0], 'args': {'returncode': process.returncode}})
+
+    def ran(self, command, start, end, returncode):
+        """Record a builtin, which runs in this process"""
+        track = threading.get_ident()
+        with self.lock:
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': track,
+                                'args': {'name': 'builtins (%s)' % threading.current_thread().name}})
+            self.events.append({'name': os.path.basename(str(command.name)), 'cat': 'builtin', 'ph': 'X', 'ts': self._ts(start),
+                                'dur': round((end - start) * 1e6, 3), 'pid': self.pid, 'tid': track,
+                                'args': {'argv': [str(command.name)] + [str(arg) for arg in command.args], 'returncode': returncode}})
+
+    def write(self, path=None):
+        """Write the trace to path, which can also be a file object. Processes
+           that are still running have no end yet."""
+        import json
+        path = path or self.path
+        with self.lock:
+            events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': 'whelk'}}] + self.events
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if hasattr(path, 'write'):
+            json.dump(trace, path)
+            return
+        with open(path, 'w') as fd:
+            json.dump(trace, fd)
+
+def _reap(process):
+    """Wait for a process to exit and return its returncode. Where possible,
+       the process is reaped with os.wait4 so its resource usage is known."""
+    if process.returncode is None and hasattr(os, 'wait4') and isinstance(process, Popen):
+        try:
+            (pid, status, rusage) = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Somebody else already reaped it
+            pass
+        else:
+            process.rusage = rusage
+            process.returncode = os.waitstatus_to_exitcode(status)
+    if not hasattr(process, 'ended'):
+        process.wait()
+        process.ended = time.time()
+    trace = getattr(process, 'trace', None)
+    if trace:
+        trace.exited(process)
+    return process.returncode
+
+class Sink(object):
+    """An output target for a process that isn't a file. This can be a
+       writable buffer such as a bytearray or mmap, which output will be read
+       into directly, or any object with a write method."""
+    def __init__(self, target):
+        self.target = target
+        self.buffer = _buffer(target)
+        self.offset = 0
+        if self.buffer is not None:
+            if self.buffer.readonly:
+                raise ValueError("Output buffer is read-only")
+            self.buffer = self.buffer.cast('B')
+
+    def readinto(self, fd, size):
+        """Read data from fd into the buffer. When the buffer is full, this
+           returns nothing so the caller treats it as EOF."""
+        end = min(self.offset + size, len(self.buffer))
+        if end == self.offset:
+            return b''
+        count = os.readv(fd, [self.buffer[self.offset:end]])
+        data = self.buffer[self.offset:self.offset+count]
+        self.offset += count
+        return data
+
+    def write(self, data):
+        if self.buffer is None:
+            self.target.write(data)
+            return
+        data = data[:len(self.buffer) - self.offset]
+        self.buffer[self.offset:self.offset+len(data)] = data
+        self.offset += len(data)
+
+    def value(self):
+        """For buffers, a memoryview of what has been written to it"""
+        if self.buffer is not None:
+            return self.buffer[:self.offset]
+
+class Spill(object):
+    """An output target that keeps output in memory until there is more than
+       threshold bytes of it. After that, output is written to a temporary
+       file, which is memory mapped when all output has been read."""
+    buffer = None
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.chunks = []
+        self.size = 0
+        self.file = None
+
+    def write(self, data):
+        if self.file:
+            self.file.write(data)
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size > self.threshold:
+            self.file = tempfile.TemporaryFile()
+            self.file.writelines(self.chunks)
+            self.chunks = None
+
+    def value(self):
+        if not self.file:
+            return b''.join(self.chunks)
+        self.file.flush()
+        try:
+            return MappedOutput(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping keeps the data around
+            self.file.close()
+
+class MappedOutput(mmap.mmap):
+    """Output that was too big to keep in memory. It supports the buffer
+       protocol, slicing, find and the other methods of mmap objects, without
+       reading everything into memory. Iterating over it generates lines."""
+    def __iter__(self):
+        """Generates lines, including the trailing newline"""
+        start, size = 0, len(self)
+        while start < size:
+            end = self.find(b'\n', start) + 1 or size
+            yield self[start:end]
+            start = end
+
+    def __eq__(self, other):
+        if _buffer(other) is None:
+            return NotImplemented
+        return len(self) == len(other) and self[:] == bytes(other)
+
+    __hash__ = None
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        return self[:].decode(encoding, errors)
+
+    def __repr__(self):
+        return '<MappedOutput of %d bytes>' % len(self)
+
+_spread = itertools.count()
+
+class Limits(object):
+    """Cpu affinity, priority, io priority and resource limits for a new
+       process. It is used as its preexec_fn, or sent to the spawn server,
+       which applies it in the new process before running the command."""
+    def __init__(self, affinity=None, nice=None, ionice=None, rlimits=None, preexec_fn=None):
+        if affinity == 'spread':
+            # Every process gets a single cpu, taking turns on all cpus we may use
+            cpus = sorted(os.sched_getaffinity(0))
+            affinity = [cpus[next(_spread) % len(cpus)]]
+        self.affinity = affinity
+        # Relative to our own priority, not to that of the spawn server
+        self.priority = None if nice is None else os.getpriority(os.PRIO_PROCESS, 0) + nice
+        self.ioprio = None if ionice is None else _ioprio(ionice)
+        if self.ioprio is not None:
+            # Find it here, loading libraries in a forked child is not safe
+            _ioprio_set_func()
+        self.rlimits = rlimits and _rlimits(rlimits)
+        self.preexec_fn = preexec_fn
+
+    def __call__(self):
+        if self.affinity is not None:
+            os.sched_setaffinity(0, self.affinity)
+        if self.priority is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.priority)
+        if self.ioprio is not None:
+            # IOPRIO_WHO_PROCESS = 1
+            if _ioprio_set_func()(1, 0, self.ioprio) < 0:
+                import ctypes
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        for (limit, value) in self.rlimits or ():
+            resource.setrlimit(limit, value)
+        if self.preexec_fn:
+            self.preexec_fn()
+
+def _rlimits(rlimits):
+    """Normalize a mapping of resource limits, such as {'as': 2**30}, to a
+       list of (resource, (soft, hard)) tuples"""
+    ret = []
+    for (limit, value) in rlimits.items():
+        if isinstance(limit, str):
+            limit = limit.upper()
+            limit = getattr(resource, limit if limit.startswith('RLIMIT_') else 'RLIMIT_' + limit)
+        if isinstance(value, int):
+            value = (value, value)
+        ret.append((limit, tuple(value)))
+    return ret
+
+_ioprio_classes = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# The ioprio_set system call has no wrapper in libc or python
+_ioprio_set_syscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+def _ioprio(ionice):
+    """Turn an io scheduling class and level, such as ('best-effort', 7) or
+       'idle', into an io priority"""
+    (cls, level) = (ionice, 0) if isinstance(ionice, (str, int)) else ionice
+    cls = _ioprio_classes.get(cls, cls)
+    if cls not in (1, 2, 3) or not 0 <= level <= 7:
+        raise ValueError("Invalid io priority: %r" % (ionice,))
+    return cls << 13 | level
+
+def _ioprio_set_func():
+    """Returns a function that calls ioprio_set with the given arguments"""
+    global _ioprio_set
+    if _ioprio_set is None:
+        import ctypes, platform
+        syscall = _ioprio_set_syscalls.get(platform.machine())
+        if not sys.platform.startswith('linux') or not syscall:
+            raise OSError("Setting io priorities is not supported on this platform")
+        libc = ctypes.CDLL(None, use_errno=True)
+        _ioprio_set = lambda *args: libc.syscall(syscall, *args)
+    return _ioprio_set
+_ioprio_set = None
+
+# Python implementations of commands, used by shells that have builtins
+# enabled. They get the arguments of a command, a function to read a file
+# ('-' is stdin) and the environment of the command, and return None if
+# they don't support the arguments, or a tuple of returncode and output.
+_builtins = {}
+# Keyword arguments that don't change what a builtin needs to do
+_builtin_kwargs = set(['stdin', 'stdout', 'stderr', 'close_fds', 'cwd', 'env', 'encoding', 'errors', 'text', 'universal_newlines'])
+
+def _builtin(name):
+    def register(func):
+        _builtins[name] = func
+        return func
+    return register
+
+def _options(args, allowed):
+    """Split arguments in single-letter options and other arguments, returns
+       None if there are options other than the allowed ones"""
+    (options, rest) = (set(), [])
+    for arg in args:
+        if arg.startswith('-') and arg != '-':
+            if arg.startswith('--') or not set(arg[1:]) <= set(allowed):
+                return None
+            options.update(arg[1:])
+        else:
+            rest.append(arg)
+    return (options, rest)
+
+def _lines(data):
+    lines = data.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return lines
+
+@_builtin('cat')
+def _cat(args, read, env):
+    if _options(args, '') is None:
+        return None
+    return (0, b''.join(read(arg) for arg in args or ['-']))
+
+@_builtin('head')
+def _head(args, read, env):
+    (lines, count, files) = (True, 10, [])
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-n', '-c') and args:
+            (lines, count) = (arg == '-n', args.pop(0))
+        elif arg[:2] in ('-n', '-c'):
+            (lines, count) = (arg[1] == 'n', arg[2:])
+        elif arg.startswith(('--lines=', '--bytes=')):
+            (lines, count) = (arg.startswith('--lines='), arg[8:])
+        elif arg.startswith('-') and arg != '-':
+            return None
+        else:
+            files.append(arg)
+        # No suffixes, negative counts or other special cases
+        if not str(count).isdigit() or not str(count).isascii():
+            return None
+        count = int(count)
+    if len(files) > 1:
+        return None
+    data = read(files[0] if files else '-')
+    if not lines:
+        return (0, data[:count])
+    end = 0
+    for _ in range(count):
+        end = data.find(b'\n', end) + 1
+        if not end:
+            return (0, data)
+    return (0, data[:end])
+
+@_builtin('wc')
+def _wc(args, read, env):
+    parsed = _options(args, 'lc')
+    if parsed is None or len(parsed[0]) != 1 or len(parsed[1]) > 1:
+        return None
+    (options, files) = parsed
+    data = read(files[0] if files else '-')
+    count = data.count(b'\n') if 'l' in options else len(data)
+    return (0, b'%d%s\n' % (count, b' ' + os.fsencode(files[0]) if files else b''))
+
+@_builtin('grep')
+def _grep(args, read, env):
+    parsed = _options(args, 'Fvcx')
+    if parsed is None or 'F' not in parsed[0] or not 1 <= len(parsed[1]) <= 2:
+        return None
+    (options, args) = parsed
+    pattern = os.fsencode(args[0])
+    if b'\n' in pattern or not pattern.isascii():
+        return None
+    data = read(args[1] if len(args) > 1 else '-')
+    # grep treats data with NUL bytes or invalid characters as binary
+    if b'\0' in data or not data.isascii() and not _utf8(data):
+        return None
+    invert = 'v' in options
+    if 'x' in options:
+        selected = [line for line in _lines(data) if (line == pattern) != invert]
+    else:
+        selected = [line for line in _lines(data) if (pattern in line) != invert]
+    if 'c' in options:
+        out = b'%d\n' % len(selected)
+    else:
+        out = b''.join(line + b'\n' for line in selected)
+    return (0 if selected else 1, out)
+
+def _utf8(data):
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+_tr_escapes = {b'\\': b'\\', b'n': b'\n', b't': b'\t', b'r': b'\r'}
+
+def _tr_set(arg):
+    """The bytes in a set of characters for tr, or None if it uses anything
+       other than plain characters, ranges and simple escapes"""
+    arg = os.fsencode(arg)
+    if not arg.isascii() or b'[' in arg:
+        return None
+    # (character, whether it was escaped)
+    chars = []
+    i = 0
+    while i < len(arg):
+        if arg[i:i+1] == b'\\':
+            char = _tr_escapes.get(arg[i+1:i+2])
+            if char is None:
+                return None
+            chars.append((char[0], True))
+            i += 2
+        else:
+            chars.append((arg[i], False))
+            i += 1
+    ret = bytearray()
+    i = 0
+    while i < len(chars):
+        if i + 2 < len(chars) and chars[i+1] == (ord('-'), False):
+            (first, last) = (chars[i][0], chars[i+2][0])
+            if first > last:
+                return None
+            ret.extend(range(first, last + 1))
+            i += 3
+        else:
+            ret.append(chars[i][0])
+            i += 1
+    return bytes(ret)
+
+@_builtin('tr')
+def _tr(args, read, env):
+    delete = args[:1] == ['-d']
+    if delete:
+        args = args[1:]
+    if len(args) != (1 if delete else 2) or any(arg.startswith('-') and arg != '-' for arg in args):
+        return None
+    sets = [_tr_set(arg) for arg in args]
+    if None in sets or not sets[-1]:
+        return None
+    data = read('-')
+    if delete:
+        return (0, data.translate(None, sets[0]))
+    (set1, set2) = sets
+    # The second set is padded with its last character
+    set2 = set2[:len(set1)] + set2[-1:] * (len(set1) - len(set2))
+    table = bytearray(range(256))
+    for (a, b) in zip(set1, set2):
+        table[a] = b
+    return (0, data.translate(bytes(table)))
+
+@_builtin('sort')
+def _sort(args, read, env):
+    parsed = _options(args, 'ru')
+    if parsed is None or not _bytewise_collation(env):
+        return None
+    (options, files) = parsed
+    lines = []
+    for f in files or ['-']:
+        lines.extend(_lines(read(f)))
+    if 'u' in options:
+        lines = set(lines)
+    lines = sorted(lines, reverse='r' in options)
+    return (0, b''.join(line + b'\n' for line in lines))
+
+def _bytewise_collation(env):
+    """Whether the locale in this environment sorts strings by their bytes"""
+    for var in ('LC_ALL', 'LC_COLLATE', 'LANG'):
+        if env.get(var):
+            return env[var] in ('C', 'POSIX', 'C.UTF-8', 'C.utf8')
+    return True
+
+def _slices(data, size):
+    """Generates slices of collected output as bytes or strings"""
+    for start in range(0, len(data), size):
+        chunk = data[start:start+size]
+        yield chunk if isinstance(chunk, (bytes, str)) else bytes(chunk)
+
+def _decoded(chunks, encoding, errors):
+    """Decode chunks of bytes as they come in, if an encoding is given"""
+    if not encoding:
+        yield from chunks
+        return
+    decoder = codecs.getincrementaldecoder(encoding)(errors or 'strict')
+    for chunk in chunks:
+        yield chunk if isinstance(chunk, str) else decoder.decode(chunk)
+    yield decoder.decode(b'', True)
+
+def _records(chunks, separator, keepends=False):
+    """Generates records from chunks of data. A trailing separator does not
+       produce an empty last record."""
+    # Only new data is searched, the unfinished record is kept as a list of
+    # pieces and joined once, so long records don't take quadratic time
+    pending = []
+    sep = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if sep is None:
+            (sep, empty) = (_like(separator, chunk), chunk[:0])
+        if len(sep) > 1 and pending:
+            # A separator may start at the end of the unfinished record
+            (size, tail) = (len(sep) - 1, [])
+            while pending and size > 0:
+                piece = pending.pop()
+                if len(piece) > size:
+                    pending.append(piece[:-size])
+                    piece = piece[-size:]
+                tail.insert(0, piece)
+                size -= len(piece)
+            chunk = empty.join(tail) + chunk
+        records = chunk.split(sep)
+        for record in records[:-1]:
+            if pending:
+                pending.append(record)
+                record = empty.join(pending)
+                pending = []
+            yield record + sep if keepends else record
+        if records[-1]:
+            pending.append(records[-1])
+    if pending:
+        yield empty.join(pending)
+
+def _like(sep, data):
+    """A separator of the same type as data"""
+    if isinstance(data, str) and not isinstance(sep, str):
+        return sep.decode('utf-8')
+    if not isinstance(data, str) and isinstance(sep, str):
+        return sep.encode('utf-8')
+    return sep
+
+def _succeeded(returncode):
+    """Whether a returncode, or all returncodes in a (nested) list of them,
+       are zero"""
+    if isinstance(returncode, int):
+        return returncode == 0
+    return all(_succeeded(x) for x in returncode)
+
+def _buffer(obj):
+    """A memoryview of obj if it supports the buffer protocol, else None"""
+    try:
+        return memoryview(obj)
+    except TypeError:
+        return None
+
+def _real_file(obj):
+    """Whether obj is a python file object for an os-level file, which a
+       process can use directly"""
+    obj = getattr(obj, 'buffer', obj)
+    obj = getattr(obj, 'raw', obj)
+    return isinstance(obj, io.FileIO)
+
+def _is_source(data):
+    """Whether input is to be read from a file-like object or iterable"""
+    if isinstance(data, str) or _buffer(data) is not None:
+        return False
+    return hasattr(data, 'read') or hasattr(data, '__iter__')
+
+def _input_chunks(data, size):
+    """Generates chunks of input from a file-like object or an iterable.
+       Small items from an iterable are batched up to size bytes, so we don't
+       need a system call for each of them."""
+    if hasattr(data, 'read'):
+        while True:
+            chunk = data.read(size)
+            if not chunk:
+                return
+            yield chunk
+    batch, length = [], 0
+    for item in data:
+        batch.append(item)
+        length += len(item)
+        if length >= size:
+            yield _join(batch)
+            batch, length = [], 0
+    if batch:
+        yield _join(batch)
+
+def _join(items):
+    """Join strings or bytes-like objects, without copying a single item"""
+    if len(items) == 1:
+        return items[0]
+    if items and isinstance(items[0], str):
+        return ''.join(items)
+    return b''.join(items)
+
+def _argset(args):
+    """Arguments for map(), which can be a single argument or a sequence"""
+    if isinstance(args, (list, tuple)):
+        return args
+    return (args,)
+
+def _batches(command, args, max_args=None):
+    """Split the arguments for batched into batches that, together with the
+       command, its other arguments and its environment, fit in the size
+       limit for a new process"""
+    if command.stream or command.background:
+        raise ValueError("Streaming and background jobs are not supported for batched commands")
+    if max_args is not None and max_args < 1:
+        raise ValueError("max_args must be at least 1")
+    env = command.sp_kwargs.get('env')
+    if env is None:
+        env = os.environ
+    # Leave some room, as POSIX recommends for xargs
+    limit = _arg_max() - 2048 - _exec_size([command.name] + list(command.args))
+    limit -= sum(len(os.fsencode(key)) + len(os.fsencode(value)) + 2 + _pointer_size for (key, value) in env.items())
+    return _split(args, limit, max_args)
+
+def _split(args, limit, max_args):
+    batch, size = [], 0
+    for arg in args:
+        arg_size = _exec_size([arg])
+        if batch and (size + arg_size > limit or len(batch) == max_args):
+            yield batch
+            batch, size = [], 0
+        batch.append(arg)
+        size += arg_size
+    if batch:
+        yield batch
+
+_pointer_size = struct.calcsize('P')
+
+def _exec_size(args):
+    """The space arguments take up when starting a process: the strings,
+       their terminating null bytes and pointers to them"""
+    return sum(len(os.fsencode(str(arg))) + 1 + _pointer_size for arg in args)
+
+def _arg_max():
+    """The maximum size of the arguments and environment of a new process"""
+    try:
+        return os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        # Windows limits the command line to 32767 characters
+        return 32767
+
+def _redirect(command):
+    """Batches that write to the same file, file object or buffer
+       would do so in whatever order they run, or overwrite each other's
+       output. Instead, their output is collected and written to its target
+       by _combined. Returns the targets per stream."""
+    targets = {}
+    for stream in ('stdout', 'stderr'):
+        if stream in command.sinks:
+            targets[stream] = command.sinks.pop(stream).target
+        elif command.sp_kwargs.get(stream) not in (PIPE, DEVNULL, STDOUT):
+            targets[stream] = command.sp_kwargs.get(stream)
+        else:
+            continue
+        command.sp_kwargs[stream] = PIPE
+    return targets
+
+def _combined(command, results, targets={}):
+    """A single result for all batches of a batched command"""
+    kwargs = command.sp_kwargs
+    text = command.encoding or command.errors or command.text or kwargs.get('universal_newlines')
+    outputs = []
+    for (index, stream) in ((1, 'stdout'), (2, 'stderr')):
+        output = [res[index] for res in results]
+        if any(data is None for data in output):
+            output = None
+        elif not output:
+            output = '' if text else b''
+        else:
+            output = _join(output)
+        if stream in targets:
+            output = _deliver(command, stream, targets[stream], output)
+        outputs.append(output)
+    return Result([res.returncode for res in results], outputs[0], outputs[1], [res.usage for res in results])
+
+def _deliver(command, stream, target, data):
+    """Write collected output to where the process would have written it,
+       and return what the result of the process would contain"""
+    if data is None:
+        return None
+    if isinstance(data, str) and not (hasattr(target, 'write') and _buffer(target) is None and not _real_file(target)):
+        data = data.encode(command.encoding or locale.getpreferredencoding(False), command.errors or 'strict')
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, 'wb') as fd:
+            fd.write(data)
+        return None
+    if target is None or isinstance(target, int) or _real_file(target):
+        if target is None:
+            getattr(sys, stream).flush()
+            fd = 1 if stream == 'stdout' else 2
+        elif isinstance(target, int):
+            fd = target
+        else:
+            target.flush()
+            fd = target.fileno()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        return None
+    sink = Sink(target)
+    sink.write(data)
+    return sink.value()
+
+def _decoder(encoding, errors):
+    """An incremental decoder that also translates newlines, like text mode
+       streams do"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors or 'strict')
+    return io.IncrementalNewlineDecoder(decoder, translate=True)
+
+class Stream(Parsers):
+    """Iterator over the output of a running command or pipe. Only stderr is
+       collected, stdout is handed out as it arrives. When all output has been
+       read, or the stream is closed, the result is available as the result
+       attribute."""
+    def __init__(self, command, process, stdin, input):
+        self.command = command
+        self.process = process
+        self.result = None
+        self.closed = False
+        self.stderr = []
+        pump = self.pump = IOPump(command, process)
+        if sys.platform == 'win32':
+            (out, err) = pump.communicate(stdin, input)
+            self.events = iter([(process.stdout, out), (process.stderr, err)])
+        else:
+            if stdin:
+                pump.add_input(stdin, input)
+            for fileobj in (process.stdout, process.stderr):
+                if fileobj:
+                    pump.add_output(fileobj)
+            command._drain_stderr(pump)
+            pump.watch(command._processes(process))
+            self.events = pump.events()
+
+    def __iter__(self):
+        return self.lines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read(self):
+        callback = self.command.output_callback
+        for fileobj, data in self.events:
+            if fileobj in self.pump.silent:
+                # Errors of earlier commands in a pipe
+                self.pump.collect(fileobj, data)
+                continue
+            if callback:
+                callback[0](self.command, self.process, fileobj, data, *callback[1:])
+            if data is None:
+                continue
+            if fileobj is self.process.stdout:
+                yield data
+            else:
+                self.stderr.append(data)
+        self.close()
+
+    def _empty(self):
+        return '' if isinstance(self.process.stdout, io.TextIOBase) else b''
+
+    def _chunks(self):
+        return self.chunks()
+
+    def chunks(self, size=None):
+        """Generates chunks of output of exactly size bytes or characters,
+           except for the last one. Without a size, chunks are generated as
+           they are read."""
+        if not size:
+            for data in self._read():
+                yield data
+            return
+        buf = self._empty()
+        for data in self._read():
+            buf += data
+            start = 0
+            while len(buf) - start >= size:
+                yield buf[start:start+size]
+                start += size
+            buf = buf[start:]
+        if buf:
+            yield buf
+
+    def lines(self):
+        """Generates lines of output, including the trailing newline"""
+        empty = self._empty()
+        nl = b'\n' if isinstance(empty, bytes) else '\n'
+        # Only new data is searched, a partial line is kept as a list of
+        # pieces and joined once it's complete
+        pending = []
+        for data in self._read():
+            start = 0
+            while True:
+                end = data.find(nl, start) + 1
+                if not end:
+                    break
+                line = data[start:end]
+                if pending:
+                    pending.append(line)
+                    line = empty.join(pending)
+                    pending = []
+                yield line
+                start = end
+            if start < len(data):
+                pending.append(data[start:])
+        if pending:
+            yield empty.join(pending)
+
+    def close(self):
+        """Stop reading output, wait for the process to exit and return the
+           result"""
+        if not self.closed:
+            self.closed = True
+            if hasattr(self.events, 'close'):
+                self.events.close()
+            _reap(self.process)
+            err = None
+            if self.process.stderr:
+                err = ('' if isinstance(self.process.stderr, io.TextIOBase) else b'').join(self.stderr)
+            self.result = self.command._finish(self.process, None, err, self.pump)
+        return self.result
+
+class Job(object):
+    """A command or pipe running in the background. Its input, output and
+       exit are handled by the job manager, so creating one does not block.
+       Output collected so far is available as stdout and stderr, and once
+       the job is done, its result as result."""
+    def __init__(self, command, process, stdin, input):
+        self.command = command
+        self.process = process
+        self.result = None
+        self.exception = None
+        self.pump = None
+        self.done = threading.Event()
+        self.processes = [process]
+        proc = command.prev if command.defer else None
+        while proc:
+            self.processes.insert(0, proc.sp)
+            proc = proc.prev
+        self.stdin = stdin
+        self.input = input
+        job_manager.add(self)
+
+    def _register(self, selector):
+        """Register input and output with the selector of the job manager"""
+        process = self.process
+        pump = self.pump = IOPump(self.command, process, selector)
+        if self.stdin:
+            pump.add_input(self.stdin, self.input)
+        for stream in ('stdout', 'stderr'):
+            fileobj = getattr(process, stream)
+            if fileobj:
+                pump.add_output(fileobj, self.command._sink(stream, isinstance(fileobj, io.TextIOBase)))
+        self.command._drain_stderr(pump)
+
+    def _finish(self):
+        try:
+            output = iter(self.pump.output())
+            out = next(output) if self.process.stdout else None
+            err = next(output) if self.process.stderr else None
+            self.result = self.command._finish(self.process, out, err, self.pump)
+        except CommandFailed as e:
+            self.result = e.result
+            self.exception = e
+        except BaseException as e:
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def _collected(self, stream):
+        if self.done.is_set():
+            return getattr(self.result, stream, None)
+        fileobj = getattr(self.process, stream)
+        chunks = self.pump.chunks.get(fileobj) if self.pump else None
+        if chunks is None:
+            return None
+        return ('' if isinstance(fileobj, io.TextIOBase) else b'').join(list(chunks))
+
+    @property
+    def stdout(self):
+        """Output collected so far"""
+        return self._collected('stdout')
+
+    @property
+    def stderr(self):
+        """Error output collected so far"""
+        return self._collected('stderr')
+
+    def poll(self):
+        """The returncode of the job, or None if it is still running. If the
+           job failed without a result, the exception is raised."""
+        if not self.done.is_set():
+            return None
+        if self.result is None:
+            raise self.exception
+        return self.result.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish and return its result. Exceptions
+           raised while finishing it, such as CommandFailed for commands
+           with raise_on_error set, are raised here."""
+        if not self.done.wait(timeout):
+            raise subprocess.TimeoutExpired(self.process.args, timeout)
+        if self.exception:
+            raise self.exception
+        return self.result
+
+    def send_signal(self, signum):
+        """Send a signal to all processes of the job that are still
+           running"""
+        for process in self.processes:
+            if process.pid and process.returncode is None:
+                process.send_signal(signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class JobManager(object):
+    """Services all background jobs from a single thread. Input, output and
+       exits of all jobs are handled by one selector loop, so thousands of
+       jobs don't need thousands of threads. Exits are noticed with pidfds
+       where the platform supports them, other processes are polled. The
+       thread is started when needed and stops when there are no jobs left."""
+    poll_interval = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.pending = []
+
+    def add(self, job):
+        """Start servicing a job"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked copy of this process needs its own loop
+                self._setup()
+            self.pending.append(job)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='whelk-jobs')
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            # A wakeup is pending already
+            pass
+
+    def _setup(self):
+        self.pid = os.getpid()
+        self.thread = None
+        self.pending = []
+        self.selector = selectors.DefaultSelector()
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        # Which job a registered input or output belongs to
+        self.owners = {}
+        # Job and process per pidfd
+        self.pidfds = {}
+        # Open inputs and outputs and running processes, per job
+        self.streams = {}
+        self.running = {}
+        # Processes that can't be watched with a pidfd, per job
+        self.polled = {}
+        # Jobs with a timeout, and when it expires
+        self.deadlines = {}
+
+    def _run(self):
+        while True:
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+                if not pending and not self.running:
+                    self.thread = None
+                    return
+            for job in pending:
+                self._add(job)
+            timeouts = [self.poll_interval] if self.polled else []
+            if self.deadlines:
+                timeouts.append(max(0, min(self.deadlines.values()) - time.monotonic()))
+            for key, mask in self.selector.select(min(timeouts) if timeouts else None):
+                if key.fd == self.wakeup_r:
+                    while True:
+                        try:
+                            os.read(self.wakeup_r, 4096)
+                        except BlockingIOError:
+                            break
+                elif key.fd in self.pidfds:
+                    self.selector.unregister(key.fd)
+                    os.close(key.fd)
+                    (job, process) = self.pidfds.pop(key.fd)
+                    self._exited(job, [process])
+                else:
+                    self._handle(self.owners[key.fd], key, mask)
+            for job in list(self.polled):
+                self._exited(job, [process for process in self.polled[job] if _poll(process)])
+            now = time.monotonic()
+            for job, deadline in list(self.deadlines.items()):
+                if deadline <= now:
+                    self._expire(job)
+
+    def _expire(self, job):
+        """Kill a job whose timeout expired and stop handling its input and
+           output. It fails with TimeoutExpired once its processes are
+           gone."""
+        del self.deadlines[job]
+        job.pump.timed_out = True
+        job.kill()
+        for fd in list(self.streams[job]):
+            key = self.selector.get_key(fd)
+            self.selector.unregister(fd)
+            key.fileobj.close()
+            del self.owners[fd]
+        self.streams[job].clear()
+        self._check(job)
+
+    def _add(self, job):
+        self.streams[job] = set()
+        self.running[job] = set()
+        try:
+            job._register(self.selector)
+        except BaseException as e:
+            job.exception = e
+        for fileobj in job.pump.registered if job.pump else ():
+            # Inputs are closed right away when there is nothing to write
+            if not fileobj.closed and fileobj in self.selector.get_map():
+                if job.exception:
+                    self.selector.unregister(fileobj)
+                    fileobj.close()
+                else:
+                    self.owners[fileobj.fileno()] = job
+                    self.streams[job].add(fileobj.fileno())
+        if job.pump and job.pump.deadline is not None and not job.exception:
+            self.deadlines[job] = job.pump.deadline
+        for process in job.processes:
+            if process.returncode is not None:
+                continue
+            self.running[job].add(process)
+            pidfd = _pidfd(process)
+            if pidfd is None:
+                self.polled.setdefault(job, set()).add(process)
+            else:
+                self.pidfds[pidfd] = (job, process)
+                self.selector.register(pidfd, selectors.EVENT_READ)
+        self._check(job)
+
+    def _handle(self, job, key, mask):
+        try:
+            for fileobj, data in job.pump.handle(key, mask):
+                job.pump.collect(fileobj, data)
+        except BaseException as e:
+            # Most likely an exception in an output callback. Stop handling
+            # this stream, the job fails when it is done.
+            job.exception = job.exception or e
+            if key.fd in self.selector.get_map():
+                self.selector.unregister(key.fd)
+                key.fileobj.close()
+        if key.fd not in self.selector.get_map():
+            del self.owners[key.fd]
+            self.streams[job].discard(key.fd)
+            self._check(job)
+
+    def _exited(self, job, processes):
+        for process in processes:
+            _reap(process)
+            self.running[job].discard(process)
+            if job in self.polled:
+                self.polled[job].discard(process)
+                if not self.polled[job]:
+                    del self.polled[job]
+        self._check(job)
+
+    def _check(self, job):
+        """Finish a job once all its processes have exited and all its
+           output has been read"""
+        if self.running[job] or self.streams[job]:
+            return
+        del self.running[job]
+        del self.streams[job]
+        self.deadlines.pop(job, None)
+        if job.exception:
+            job.done.set()
+        else:
+            job._finish()
+
+def _pidfd(process):
+    """A file descriptor that becomes readable when a process exits, or None
+       if there is no way to get one"""
+    if not process.pid or not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(process.pid)
+    except OSError:
+        return None
+
+def _poll(process):
+    """Whether a process has exited, reaping it with os.wait4 if possible
+       so its resource usage is known"""
+    if process.returncode is None and hasattr(os, 'wait4') and isinstance(process, Popen) and not isinstance(process, ServerPopen):
+        try:
+            (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            return process.poll() is not None
+        if pid:
+            process.rusage = rusage
+            process.returncode = os.waitstatus_to_exitcode(status)
+    return process.poll() is not None
 
 class CommandFailed(RuntimeError):
     def __init__(self, result):
@@ -308,3 +3206,6 @@ class CommandFailed(RuntimeError):
 # use it.
 shell = Shell()
 pipe = Pipe()
+spawn_server = SpawnServer()
+job_manager = JobManager()
+result_cache = ResultCache()
@@ -1,6 +1,6 @@
 from whelk import *
 import unittest
-import sys, os
+import sys, os, shutil, tempfile
 
 os.environ['PATH'] = os.pathsep.join([
     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'),
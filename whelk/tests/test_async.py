@@ -0,0 +1,81 @@
+from whelk.tests import *
+import asyncio
+import subprocess
+import time
+
+ashell = AsyncShell()
+apipe = AsyncPipe()
+
+def run(coro):
+    return asyncio.run(coro)
+
+class AsyncTest(unittest.TestCase):
+    """Tests the asyncio shell and pipe"""
+    def test_basic(self):
+        r = run(ashell.test_return('22', 'stdout', 'stderr'))
+        self.assertEqual(r, (22, b'stdout\n', b'stderr\n'))
+        self.assertRaises(AttributeError, lambda: ashell.i_do_not_exist)
+
+    def test_input(self):
+        input = '\u041f\u0440\u0438\u0432\u0435\u0442, \u043c\u0438\u0440!\r\n'
+        r = run(AsyncShell(encoding='utf-8').cat(input=input))
+        self.assertEqual(r.stdout, input.replace('\r\n', '\n'))
+        self.assertEqual(r.stderr, '')
+
+    def test_gather(self):
+        async def main():
+            return await asyncio.gather(*[ashell.test_return(x, x) for x in range(20)])
+        results = run(main())
+        self.assertEqual([r.returncode for r in results], list(range(20)))
+        self.assertEqual([r.stdout for r in results], [b'%d\n' % x for x in range(20)])
+
+    def test_pipe(self):
+        input = b"123456789ABCDEF" * 65536 * 16 # 16 MB
+        r = run(apipe(
+            apipe.tr('a-zA-Z', 'k-za-jK-ZA-J', input=input) |
+            apipe.tr('a-zA-Z', 'k-za-jK-ZA-J') |
+            apipe.tr('a-zA-Z', 'g-za-fG-ZA-F')
+        ))
+        self.assertEqual(r.returncode, [0,0,0])
+        self.assertEqual(r.stdout, input)
+        self.assertEqual(r.stderr, b'')
+
+        r = run(apipe(apipe.test_return(0) | apipe.test_return(1, "", "error", stderr=STDOUT) | apipe.cat()))
+        self.assertEqual(r.returncode, [0,1,0])
+        self.assertEqual(r.stdout, b'error\n')
+
+    def test_callbacks(self):
+        calls = []
+        def output_cb(command, sp, fd, data):
+            calls.append(('output', data))
+        def exit_cb(command, sp, res):
+            calls.append(('exit', res.returncode))
+        def run_cb(command):
+            calls.append(('run', command.args))
+        s = AsyncShell(output_callback=output_cb, exit_callback=exit_cb, run_callback=run_cb)
+        run(s.test_return(0, 'output'))
+        self.assertEqual(calls[0], ('run', (0, 'output')))
+        self.assertEqual(sorted(calls[1:4], key=repr), [('output', None), ('output', None), ('output', b'output\n')])
+        self.assertEqual(calls[4], ('exit', 0))
+
+    def test_raises(self):
+        try:
+            run(apipe(apipe.true() | apipe.test_return(1, raise_on_error=True)))
+        except CommandFailed as e:
+            self.assertEqual(e.result.returncode, [0, 1])
+        else:
+            self.fail("No exception was raised")
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(subprocess.TimeoutExpired, run, ashell.sleep(10, timeout=0.2))
+        self.assertRaises(subprocess.TimeoutExpired, run, apipe(apipe.sleep(10) | apipe.cat(timeout=0.2)))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(run(ashell.echo('hi', timeout=5)).stdout, b'hi\n')
+
+    def test_lazy_import(self):
+        # Code that doesn't use asyncio doesn't pay for importing it
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        code = 'import sys, whelk; print([m for m in ("asyncio", "concurrent.futures") if m in sys.modules])'
+        r = shell[sys.executable]('-c', code, env=dict(os.environ, PYTHONPATH=root))
+        self.assertEqual(r.stdout, b'[]\n')
@@ -38,3 +38,33 @@ class BasicTest(unittest.TestCase):
         r = s.cat(input=input)
         self.assertEqual(r.returncode, 0)
         self.assertEqual(r.stdout, input)
+
+    def test_which(self):
+        self.assertTrue(shell.which('test_return').endswith('/bin/test_return'))
+        self.assertTrue(shell.which('test_dashes').endswith('/bin/test-dashes'))
+        self.assertEqual(shell.which('i_do_not_exist'), None)
+        self.assertTrue('test_return' in shell)
+        self.assertFalse('i_do_not_exist' in shell)
+        self.assertFalse('/not/found' in shell)
+
+    def test_path_index(self):
+        d = tempfile.mkdtemp()
+        old_path = os.environ['PATH']
+        try:
+            os.environ['PATH'] = os.pathsep.join([d, old_path])
+            self.assertFalse('whelk_test_cmd' in shell)
+            with open(os.path.join(d, 'whelk_test_cmd'), 'w') as fd:
+                fd.write("#!/bin/sh\necho hello\n")
+            os.chmod(fd.name, 0o755)
+            # Make sure the mtime changes on filesystems with coarse timestamps
+            st = os.stat(d)
+            os.utime(d, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            shell.path_index.interval, interval = 0, shell.path_index.interval
+            try:
+                self.assertEqual(shell.whelk_test_cmd().stdout, b'hello\n')
+            finally:
+                shell.path_index.interval = interval
+        finally:
+            os.environ['PATH'] = old_path
+            shutil.rmtree(d)
+        self.assertFalse('whelk_test_cmd' in shell)
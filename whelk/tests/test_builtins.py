@@ -0,0 +1,125 @@
+from whelk.tests import *
+import whelk
+
+data = b'banana\nApple\ncherry\n\napple pie\nbanana\n\xc3\xa9clair\ndate'
+c_env = dict(os.environ, LC_ALL='C')
+
+class BuiltinTest(unittest.TestCase):
+    """Tests for python implementations of simple commands. Every call is
+       compared to that of the real command."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'data')
+        with open(self.file, 'wb') as fd:
+            fd.write(data)
+        self.builtins = Shell(builtins=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSame(self, cmd, *args, **kwargs):
+        builtin = True
+        if isinstance(cmd, tuple):
+            (cmd, builtin) = cmd
+        expected = shell[cmd](*args, **kwargs)
+        res = self.builtins[cmd](*args, **kwargs)
+        self.assertEqual(res, expected, "%s %s" % (cmd, args))
+        # Only real processes have cpu times
+        self.assertEqual(res.usage.utime is None, builtin, "%s %s" % (cmd, args))
+
+    def test_cat(self):
+        self.assertSame('cat', input=data)
+        self.assertSame('cat', self.file)
+        self.assertSame('cat', self.file, '-', self.file, input=b'stdin\n')
+        self.assertSame('cat', '-', '-', input=b'stdin\n')
+        self.assertSame('cat', input='text', encoding='utf-8')
+        self.assertSame('cat', 'data', cwd=self.dir)
+        self.assertSame(('cat', False), '-n', self.file)
+        self.assertSame(('cat', False), '/nonexistent')
+
+    def test_head(self):
+        for args in ([], ['-n', '3'], ['-n2'], ['--lines=0'], ['-c', '9'], ['-c10000'], ['-n', '100']):
+            self.assertSame('head', *args, input=data)
+            self.assertSame('head', *(args + [self.file]))
+        self.assertSame('head', self.file, '-n', '1')
+        for args in (['-n', '-2'], ['-c', '1k'], ['-5'], [self.file, self.file]):
+            self.assertSame(('head', False), *args, input=data)
+
+    def test_wc(self):
+        for args in (['-l'], ['-c'], ['-l', self.file], ['-c', self.file], ['-l', '-']):
+            self.assertSame('wc', *args, input=data)
+        for args in ([], ['-w'], ['-lc'], ['-l', self.file, self.file]):
+            self.assertSame(('wc', False), *args, input=data)
+
+    def test_grep(self):
+        for args in (['-F', 'an'], ['-Fv', 'an'], ['-F', '-c', 'an'], ['-Fx', 'banana'], ['-F', 'nope'],
+                     ['-Fc', 'nope'], ['-F', ''], ['-Fx', ''], ['-F', 'date'], ['-F', 'clair'], ['-F', 'an', self.file]):
+            self.assertSame('grep', *args, input=data)
+        self.assertSame('grep', '-F', 'x', input=b'')
+        self.assertSame('grep', '-F', 'an', input='banana\n', encoding='utf-8')
+        for args in (['an'], ['-Fi', 'an'], ['-F', 'an', self.file, self.file]):
+            self.assertSame(('grep', False), *args, input=data)
+        self.assertSame(('grep', False), '-F', 'a', input=b'a\0b\n')
+        self.assertSame(('grep', False), '-F', 'a', input=b'a\xff\n', env=dict(os.environ, LC_ALL='C.UTF-8'))
+
+    def test_tr(self):
+        for args in (['a-z', 'A-Z'], ['abc', 'x'], ['a-c', 'xyz-'], ['-d', 'a-e'], ['\\n', ' '], ['aa', 'xy'],
+                     ['-', '_'], ['a-', 'xy'], ['\\\\', '/'], ['\\t-\\r', 'a']):
+            self.assertSame('tr', *args, input=data + b'\t\\x-')
+        for args in (['[:lower:]', '[:upper:]'], ['-s', 'a'], ['a'], ['z-a', 'x'], ['\\101', 'x'], ['-d', 'a', 'b']):
+            self.assertSame(('tr', False), *args, input=data)
+
+    def test_sort(self):
+        for args in ([], ['-r'], ['-u'], ['-ru'], [self.file], [self.file, '-', self.file]):
+            self.assertSame('sort', *args, input=data, env=c_env)
+        for args in (['-n'], ['-k', '2'], ['-f']):
+            self.assertSame(('sort', False), *args, input=data, env=c_env)
+        self.assertSame(('sort', False), input=data, env=dict(os.environ, LC_ALL='en_US.UTF-8'))
+
+    def test_fallback(self):
+        # Other arguments than the output, or being part of a pipe, need the
+        # real command
+        self.assertSame(('cat', False), input=data, stream=False, output_callback=lambda *args: None)
+        self.assertSame(('cat', False), input=data, nice=1)
+        self.assertSame(('cat', False), input=data, builtins=False)
+        r = pipe(pipe.cat(input=data) | Pipe(builtins=True).wc('-l'))
+        self.assertEqual(r, ([0, 0], b'7\n', b''))
+        self.assertIsNotNone(r.usage[1].utime)
+
+    def test_selection(self):
+        sh = Shell(builtins=['wc'])
+        self.assertIsInstance(sh.wc, whelk.Builtin)
+        self.assertNotIsInstance(sh.cat, whelk.Builtin)
+        self.assertNotIsInstance(shell.wc, whelk.Builtin)
+        self.assertNotIsInstance(AsyncShell(builtins=True).wc, whelk.Builtin)
+
+    def test_callbacks(self):
+        calls = []
+        r = self.builtins.wc('-l', input=data, run_callback=lambda cmd: calls.append('run'),
+                             exit_callback=lambda cmd, sp, res: calls.append(res.stdout))
+        self.assertEqual(calls, ['run', b'7\n'])
+        self.assertRaises(CommandFailed, self.builtins.grep, '-F', 'nope', input=data, raise_on_error=True)
+        # The callback runs before the builtin, and once when it falls back
+        calls = []
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'data')
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            def run(cmd):
+                calls.append('run')
+                with open(path, 'wb') as fd:
+                    fd.write(b'written by the callback')
+            self.assertEqual(self.builtins.cat(path, run_callback=run).stdout, b'written by the callback')
+            self.builtins.wc('--nonexistent-option', input=data, run_callback=run)
+            self.assertEqual(calls, ['run', 'run'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_prepare(self):
+        count = self.builtins.prepare(self.builtins.wc, '-l')
+        self.assertEqual(count(input=b'a\nb\n').stdout, b'2\n')
+        self.assertEqual(count(input=data).stdout, b'7\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+from whelk.tests import *
+import asyncio
+import io
+import json
+import time
+
+class CacheTest(unittest.TestCase):
+    """Tests for the result cache"""
+    def setUp(self):
+        self.cache = ResultCache()
+        self.shell = Shell(cache=self.cache)
+        self.runs = []
+        self.shell.defaults['run_callback'] = lambda cmd: self.runs.append(cmd)
+
+    def test_cache(self):
+        r1 = self.shell.echo('hello')
+        r2 = self.shell.echo('hello')
+        self.assertEqual(r1, r2)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.shell.echo('world')
+        self.shell.echo('hello', encoding='utf-8')
+        self.shell.cat(input=b'hello')
+        self.shell.cat(input='world', encoding='utf-8')
+        self.shell.cat(input=b'world')
+        self.assertEqual(len(self.runs), 6)
+        # No input is the same as empty input
+        self.shell.cat(input=None)
+        self.shell.cat(input='')
+        self.shell.cat()
+        self.assertEqual(len(self.runs), 7)
+
+    def test_uncacheable(self):
+        self.shell.cat(input=iter([b'hello']))
+        self.shell.cat(input=iter([b'hello']))
+        self.shell.echo('hello', stdout=io.BytesIO())
+        self.shell.echo('hello', stdout=io.BytesIO())
+        p = Pipe(cache=self.cache)
+        p(p.echo('hello') | p.cat())
+        p(p.echo('hello') | p.cat())
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_cwd_env(self):
+        self.shell.pwd(cwd='/')
+        self.shell.pwd(cwd='/tmp')
+        self.shell.env(env={'FOO': 'bar'})
+        self.shell.env(env={'FOO': 'baz'})
+        self.assertEqual(len(self.runs), 4)
+
+        cache = ResultCache(env=['WHELK_CACHE_TEST'])
+        os.environ['WHELK_CACHE_TEST'] = '1'
+        try:
+            shell.env(cache=cache)
+            os.environ['WHELK_CACHE_TEST'] = '2'
+            shell.env(cache=cache)
+        finally:
+            del os.environ['WHELK_CACHE_TEST']
+        self.assertEqual(cache.misses, 2)
+
+    def test_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.shell.cat(f.name, cache_files=[f.name])
+            self.shell.cat(f.name, cache_files=[f.name])
+            f.write(b'changed')
+            f.flush()
+            os.utime(f.name, ns=(0, 0))
+            r = self.shell.cat(f.name, cache_files=[f.name])
+            self.assertEqual(r.stdout, b'changed')
+        self.assertEqual(len(self.runs), 2)
+
+    def test_eviction(self):
+        self.cache.maxsize = 2
+        for word in ('foo', 'bar', 'foo', 'baz', 'foo', 'bar'):
+            self.shell.echo(word)
+        self.assertEqual(len(self.cache.entries), 2)
+        self.assertEqual([r.args[0] for r in self.runs], ['foo', 'bar', 'baz', 'bar'])
+
+        self.cache.maxsize = 100
+        self.cache.maxbytes = 10
+        self.shell.echo('1234567')
+        self.shell.echo('1234')
+        self.assertEqual(len(self.cache.entries), 1)
+
+    def test_ttl(self):
+        self.cache.ttl = 0.1
+        self.shell.echo('hello')
+        self.shell.echo('hello')
+        time.sleep(0.2)
+        self.shell.echo('hello')
+        self.assertEqual(len(self.runs), 2)
+
+    def test_disk(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(path=path, maxsize=2)
+            r = shell.echo('hello', cache=cache)
+            cache.entries.clear()
+            r2 = Shell(cache=ResultCache(path=path), run_callback=lambda cmd: self.fail("Command was run")).echo('hello')
+            self.assertEqual(r, r2)
+            shell.echo('world', cache=cache)
+            shell.echo('again', cache=cache)
+            self.assertEqual(len(os.listdir(path)), 2)
+            cache.clear()
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path)
+
+    def test_disk_format(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(path=os.path.join(path, 'cache'))
+            self.assertEqual(os.stat(cache.path).st_mode & 0o777, 0o700)
+            r = shell.test_return(3, '\xff', cache=cache)
+            t = shell.echo('€', encoding='utf-8', cache=cache)
+            # Results are stored as json, never as pickles
+            for name in os.listdir(cache.path):
+                with open(os.path.join(cache.path, name)) as fd:
+                    self.assertIsInstance(json.load(fd), dict)
+            cache.entries.clear()
+            self.assertEqual(shell.test_return(3, '\xff', cache=cache), r)
+            self.assertEqual(shell.echo('€', encoding='utf-8', cache=cache), t)
+            self.assertEqual(cache.hits, 2)
+            # Broken files are ignored
+            for name in os.listdir(cache.path):
+                with open(os.path.join(cache.path, name), 'wb') as fd:
+                    fd.write(b'\x80\x04garbage')
+            cache.entries.clear()
+            self.assertEqual(shell.test_return(3, '\xff', cache=cache), r)
+            self.assertEqual(cache.misses, 3)
+
+            os.chmod(cache.path, 0o777)
+            self.assertRaises(PermissionError, ResultCache, path=cache.path)
+        finally:
+            shutil.rmtree(path)
+
+    def test_callbacks(self):
+        exits = []
+        self.shell.defaults['exit_callback'] = lambda cmd, sp, res: exits.append(sp)
+        self.shell.test_return('1')
+        self.assertRaises(CommandFailed, self.shell.test_return, '1', raise_on_error=True)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(exits[1:], [None])
+        # Output callbacks always see the output
+        outputs = []
+        for _ in range(2):
+            self.shell.echo('hi', output_callback=lambda cmd, sp, fd, data: outputs.append(data) if data else None)
+        self.assertEqual(outputs, [b'hi\n', b'hi\n'])
+
+    def test_async(self):
+        ashell = AsyncShell(cache=self.cache)
+        r1 = asyncio.run(ashell.echo('hello'))
+        r2 = asyncio.run(ashell.echo('hello'))
+        self.assertEqual(r1, r2)
+        self.assertEqual(self.cache.hits, 1)
@@ -29,6 +29,35 @@ class CallbackTest(unittest.TestCase):
         p(p.true(run_callback=None)|p.true(exit_callback=None))
         self.assertEqual(cb_called, [2,1,2])
 
+    def test_read_size(self):
+        chunks = []
+        def cb(shell, sp, fd, data):
+            if data is not None:
+                chunks.append(data)
+        r = shell.cat(input=b'x' * 1000, read_size=100, output_callback=cb)
+        self.assertEqual(r.stdout, b'x' * 1000)
+        self.assertEqual(max(len(chunk) for chunk in chunks), 100)
+
+    def test_text_callback(self):
+        chunks = []
+        def cb(shell, sp, fd, data):
+            if data is not None:
+                chunks.append(data)
+        input = '\u041f\u0440\u0438\u0432\u0435\u0442\r\n' * 100
+        r = shell.cat(input=input, encoding='utf-8', read_size=7, output_callback=cb)
+        self.assertEqual(r.stdout, input.replace('\r\n', '\n'))
+        self.assertEqual(''.join(chunks), r.stdout)
+
+    def test_pipe_callback(self):
+        chunks = []
+        def cb(shell, sp, fd, data):
+            if data is not None:
+                chunks.append(data)
+        r = pipe(pipe.test_data(2) | pipe.cat(output_callback=cb))
+        self.assertEqual(r.returncode, [0, 0])
+        self.assertEqual(len(r.stdout), 2 * 1024 * 1024)
+        self.assertEqual(b''.join(chunks), r.stdout)
+
     def test_exit_callback(self):
         cb_called = []
         def cb(shell, sp, res):
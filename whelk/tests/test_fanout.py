@@ -0,0 +1,49 @@
+from whelk.tests import *
+
+class FanoutTest(unittest.TestCase):
+    """Tests for sending output to multiple branches"""
+    def test_fanout(self):
+        runs = []
+        p = Pipe(run_callback=lambda cmd: runs.append(cmd.name))
+        r = p(p.seq(100000) | p.fanout(p.grep('7') | p.wc('-l'), p.tail('-n1'), p.md5sum(encoding='ascii')))
+        self.assertEqual(r.returncode, [0, [0, 0], [0], [0]])
+        self.assertEqual(r.stdout[:2], [b'40951\n', b'100000\n'])
+        self.assertEqual(r.stdout[2], shell.md5sum(input=shell.seq(100000).stdout, encoding='ascii').stdout)
+        self.assertEqual(r.stderr, [b'', b'', ''])
+        self.assertEqual(len(r.usage), 4)
+        self.assertEqual([os.path.basename(x) for x in runs].count('seq'), 1)
+        self.assertTrue(r)
+
+    def test_returncodes(self):
+        r = pipe(pipe.cat(input=b'foo\n') | pipe.fanout(pipe.grep('bar'), pipe.grep('foo')))
+        self.assertEqual(r.returncode, [0, [1], [0]])
+        self.assertFalse(r)
+
+    def test_early_exit(self):
+        r = pipe(pipe.seq(1000000) | pipe.fanout(pipe.head('-n1'), pipe.wc('-l')))
+        self.assertEqual(r.stdout, [b'1\n', b'1000000\n'])
+        r = pipe(pipe.seq(1000000) | pipe.fanout(pipe.head('-n1'), pipe.head('-n2')))
+        self.assertEqual(r.stdout, [b'1\n', b'1\n2\n'])
+        self.assertEqual(r.returncode[1:], [[0], [0]])
+
+    def test_input(self):
+        r = pipe(pipe.fanout(pipe.cat(), pipe.wc('-c'), input=b'hello'))
+        self.assertEqual(r, ([[0], [0]], [b'hello', b'5\n'], [b'', b'']))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, pipe.fanout, shell.cat)
+        self.assertRaises(TypeError, pipe.fanout, 'cat')
+        self.assertRaises(ValueError, pipe.fanout, pipe.cat)
+        self.assertRaises(TypeError, lambda: pipe.fanout(pipe.cat()) | pipe.cat())
+
+    def test_real_tee(self):
+        # The tee command is still available
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out.txt')
+            r = pipe(pipe.echo('hi') | pipe.tee(path))
+            self.assertEqual(r, ([0, 0], b'hi\n', b''))
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), b'hi\n')
+        finally:
+            shutil.rmtree(tmp)
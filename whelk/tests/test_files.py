@@ -0,0 +1,87 @@
+from whelk.tests import *
+import asyncio
+import io
+import mmap
+import pathlib
+
+class FileTest(unittest.TestCase):
+    """Tests files, buffers and file-like objects as input and output"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = pathlib.Path(self.dir, 'input')
+        self.data = b"123456789ABCDEF\n" * 65536
+        with open(self.path, 'wb') as fd:
+            fd.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_input_path(self):
+        r = shell.cat(input=self.path)
+        self.assertEqual(r.stdout, self.data)
+        r = pipe(pipe.cat(input=self.path) | pipe.wc('-l'))
+        self.assertEqual(r.stdout.strip(), b'65536')
+
+    def test_input_file(self):
+        with open(self.path, 'rb') as fd:
+            fd.read(16)
+            r = shell.cat(input=fd)
+        self.assertEqual(r.stdout, self.data[16:])
+
+    def test_input_filelike(self):
+        r = shell.cat(input=io.BytesIO(self.data), read_size=1000)
+        self.assertEqual(r.stdout, self.data)
+        r = shell.cat(input=io.StringIO('Hello, world!'), encoding='utf-8')
+        self.assertEqual(r.stdout, 'Hello, world!')
+
+    def test_input_buffer(self):
+        with open(self.path, 'rb') as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                r = pipe(pipe.cat(input=m) | pipe.cat())
+                self.assertEqual(r.stdout, self.data)
+                r = shell.cat(input=memoryview(m)[:16])
+                self.assertEqual(r.stdout, self.data[:16])
+
+    def test_output_path(self):
+        out = os.path.join(self.dir, 'output')
+        r = shell.cat(input=self.data, stdout=out)
+        self.assertEqual(r.stdout, None)
+        with open(out, 'rb') as fd:
+            self.assertEqual(fd.read(), self.data)
+        r = pipe(pipe.cat(input=self.path) | pipe.tr('A-F', 'a-f', stdout=pathlib.Path(out)))
+        self.assertEqual(r.returncode, [0, 0])
+        with open(out, 'rb') as fd:
+            self.assertEqual(fd.read(), self.data.lower())
+
+    def test_output_filelike(self):
+        out = io.BytesIO()
+        r = shell.cat(input=self.data, stdout=out)
+        self.assertEqual(r.stdout, None)
+        self.assertEqual(out.getvalue(), self.data)
+        out = io.StringIO()
+        shell.test_return(0, '', 'error', stderr=out, encoding='utf-8')
+        self.assertEqual(out.getvalue(), 'error\n')
+
+    def test_output_buffer(self):
+        buf = bytearray(len(self.data))
+        r = shell.cat(input=self.path, stdout=buf)
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.stdout, self.data)
+        self.assertEqual(buf, self.data)
+
+        # When the buffer is full, the process doesn't get to write any more
+        buf = bytearray(100)
+        r = shell.test_data(16, stdout=buf)
+        self.assertTrue(r.returncode != 0)
+        self.assertEqual(len(r.stdout), 100)
+
+        self.assertRaises(ValueError, lambda: shell.cat(stdout=b'read-only'))
+
+    def test_async(self):
+        out = io.BytesIO()
+        r = asyncio.run(AsyncShell().cat(input=io.BytesIO(self.data), stdout=out))
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(out.getvalue(), self.data)
+        buf = bytearray(len(self.data))
+        r = asyncio.run(AsyncShell().cat(input=self.path, stdout=buf))
+        self.assertEqual(buf, self.data)
@@ -0,0 +1,46 @@
+from whelk.tests import *
+import asyncio
+
+class IterInputTest(unittest.TestCase):
+    """Tests feeding input from iterables"""
+    def test_generator(self):
+        r = shell.sort('-n', input=(b'%d\n' % x for x in range(1000, 0, -1)))
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.stdout, b''.join(b'%d\n' % x for x in range(1, 1001)))
+
+        r = shell.cat(input=['Hello', ', ', 'world!'], encoding='utf-8')
+        self.assertEqual(r.stdout, 'Hello, world!')
+
+        r = shell.cat(input=iter([]))
+        self.assertEqual(r.stdout, b'')
+
+    def test_backpressure(self):
+        produced = []
+        def generate():
+            for i in range(1024):
+                produced.append(i)
+                yield b'x' * 65536
+        with shell.cat(input=generate(), stream=True) as s:
+            for chunk in s.chunks():
+                # Only what fits in the pipe buffers has been read
+                self.assertTrue(len(produced) < 64)
+                break
+
+    def test_pipe(self):
+        def generate():
+            for i in range(100000):
+                yield 'line %d\n' % i
+        r = pipe(pipe.cat(input=generate(), encoding='utf-8') | pipe.grep('-c', '7'))
+        self.assertEqual(r.returncode, [0, 0])
+        self.assertEqual(r.stdout, b'40951\n')
+
+    def test_broken_pipe(self):
+        def generate():
+            while True:
+                yield b'y\n'
+        r = shell.head('-n', 1, input=generate())
+        self.assertEqual(r.stdout, b'y\n')
+
+    def test_async(self):
+        r = asyncio.run(AsyncShell().wc('-l', input=(b'%d\n' % x for x in range(1000))))
+        self.assertEqual(r.stdout.strip(), b'1000')
@@ -0,0 +1,108 @@
+from whelk.tests import *
+import signal
+import subprocess
+import threading
+import time
+import whelk
+
+class JobTest(unittest.TestCase):
+    """Tests for commands running in the background"""
+    def test_job(self):
+        job = shell.sh('-c', 'cat; echo err >&2', input=b'hello\n', background=True)
+        self.assertIsInstance(job, whelk.Job)
+        r = job.wait()
+        self.assertEqual(r, (0, b'hello\n', b'err\n'))
+        self.assertEqual(job.poll(), 0)
+        self.assertIs(job.result, r)
+        self.assertIsNotNone(r.usage.utime)
+
+    def test_poll(self):
+        job = shell.sleep(0.5, background=True)
+        self.assertIsNone(job.poll())
+        self.assertRaises(subprocess.TimeoutExpired, job.wait, 0.1)
+        self.assertEqual(job.wait(5).returncode, 0)
+
+    def test_output_so_far(self):
+        job = shell.sh('-c', 'echo one; sleep 1; echo two', background=True, encoding='utf-8')
+        deadline = time.time() + 5
+        while job.stdout != 'one\n' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(job.stdout, 'one\n')
+        self.assertIsNone(job.poll())
+        self.assertEqual(job.wait().stdout, 'one\ntwo\n')
+
+    def test_many(self):
+        before = threading.active_count()
+        jobs = [shell.sh('-c', 'sleep 0.2; echo $0', i, background=True) for i in range(200)]
+        # One thread services them all
+        self.assertLessEqual(threading.active_count(), before + 1)
+        for (i, job) in enumerate(jobs):
+            self.assertEqual(job.wait(10), (0, b'%d\n' % i, b''))
+
+    def test_pipe(self):
+        job = pipe(pipe.seq(1000) | pipe.grep('0$') | pipe.wc('-l', background=True))
+        r = job.wait(5)
+        self.assertEqual(r, ([0, 0, 0], b'100\n', b''))
+        self.assertEqual(len(r.usage), 3)
+
+    def test_kill(self):
+        job = shell.sleep(10, background=True)
+        job.kill()
+        self.assertEqual(job.wait(5).returncode, -signal.SIGKILL)
+
+    def test_large_input(self):
+        data = b'x' * (4 * 1024 * 1024)
+        self.assertEqual(shell.wc('-c', input=data, background=True).wait(10).stdout, b'%d\n' % len(data))
+
+    def test_callbacks(self):
+        chunks = []
+        done = []
+        job = shell.echo('hi', background=True, output_callback=lambda cmd, sp, fd, data: chunks.append(data),
+                         exit_callback=lambda cmd, sp, res: done.append(res.returncode))
+        job.wait(5)
+        self.assertEqual(chunks, [b'hi\n', None, None])
+        self.assertEqual(done, [0])
+
+    def test_raise(self):
+        job = shell.false(background=True, raise_on_error=True)
+        self.assertRaises(CommandFailed, job.wait, 5)
+        self.assertEqual(job.poll(), 1)
+
+    def test_poll_exception(self):
+        def callback(cmd, sp, fd, data):
+            raise ValueError("Callback failed")
+        job = shell.echo('hi', background=True, output_callback=callback)
+        self.assertRaises(ValueError, job.wait, 5)
+        self.assertRaises(ValueError, job.poll)
+
+    def test_polled(self):
+        # Python stages have no process to get a pidfd for
+        job = pipe(pipe.seq(3) | pipe.py(lambda lines: (l * 2 for l in lines), background=True))
+        self.assertEqual(job.wait(5).stdout, b'1\n1\n2\n2\n3\n3\n')
+
+    def test_no_pidfd(self):
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open:
+            del os.pidfd_open
+        try:
+            jobs = [shell.sh('-c', 'exit $0', i, background=True) for i in range(5)]
+            self.assertEqual([job.wait(5).returncode for job in jobs], list(range(5)))
+            self.assertIsNotNone(jobs[0].result.usage.utime)
+        finally:
+            if pidfd_open:
+                os.pidfd_open = pidfd_open
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, pipe.fanout, pipe.cat(), background=True)
+
+    def test_timeout(self):
+        start = time.time()
+        job = shell.sh('-c', 'echo partial; exec sleep 10', background=True, timeout=0.2)
+        with self.assertRaises(subprocess.TimeoutExpired) as ctx:
+            job.wait()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ctx.exception.output, b'partial\n')
+        self.assertEqual(shell.echo('hi', background=True, timeout=5).wait().stdout, b'hi\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+from whelk.tests import *
+import asyncio
+import resource
+import subprocess
+import whelk
+
+def status(field):
+    return "awk '/^%s:/ {print $2}' /proc/self/status" % field
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "Uses /proc")
+class LimitTest(unittest.TestCase):
+    """Tests for cpu affinity, priorities and resource limits"""
+    def test_affinity(self):
+        cpu = sorted(os.sched_getaffinity(0))[-1]
+        r = shell.sh('-c', status('Cpus_allowed_list'), affinity=[cpu])
+        self.assertEqual(r.stdout, b'%d\n' % cpu)
+
+    def test_spread(self):
+        cpus = sorted(os.sched_getaffinity(0))
+        seen = set()
+        for _ in cpus:
+            seen.add(int(shell.sh('-c', status('Cpus_allowed_list'), affinity='spread').stdout))
+        self.assertEqual(seen, set(cpus))
+
+    def test_nice(self):
+        r = shell.sh('-c', 'cut -d" " -f19 /proc/self/stat', nice=5)
+        self.assertEqual(int(r.stdout), os.getpriority(os.PRIO_PROCESS, 0) + 5)
+
+    def test_nice_zero(self):
+        # The spawn server keeps the priority it started with, a process it
+        # starts with nice=0 should get ours
+        code = '; '.join([
+            'import os, whelk',
+            'whelk.shell.true(spawn="server")',
+            'os.nice(3)',
+            'print(int(whelk.shell.sh("-c", %r, nice=0, spawn="server").stdout))' % 'cut -d" " -f19 /proc/self/stat',
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        r = shell[sys.executable]('-c', code, env=dict(os.environ, PYTHONPATH=root))
+        self.assertEqual(r.returncode, 0, r.stderr)
+        self.assertEqual(int(r.stdout), os.getpriority(os.PRIO_PROCESS, 0) + 3)
+
+    def test_ionice(self):
+        r = shell.ionice(ionice=('best-effort', 6))
+        self.assertEqual(r.stdout, b'best-effort: prio 6\n')
+        r = shell.ionice(ionice='idle')
+        self.assertEqual(r.stdout, b'idle\n')
+        self.assertRaises(ValueError, shell.ionice, ionice=('best-effort', 8))
+        self.assertRaises(ValueError, shell.ionice, ionice='fast')
+
+    def test_rlimits(self):
+        r = shell.sh('-c', 'ulimit -n; ulimit -Hn; ulimit -t', rlimits={'nofile': (64, 128), 'RLIMIT_CPU': 60})
+        self.assertEqual(r.stdout, b'64\n128\n60\n')
+
+    def test_spawn(self):
+        for spawn in ('posix_spawn', 'server'):
+            r = shell.sh('-c', 'ulimit -n', rlimits={'nofile': 64}, spawn=spawn)
+            self.assertEqual(r.stdout, b'64\n')
+        r = shell.sh('-c', 'ionice; ' + status('Cpus_allowed_list'), ionice='idle', affinity=[0], nice=3, spawn='server')
+        self.assertEqual(r.stdout, b'idle\n0\n')
+        self.assertRaises(FileNotFoundError, shell.sleep, 10, nice=1, cwd='/nonexistent', spawn='server')
+
+    def test_server_by_default(self):
+        # Limited commands avoid the preexec_fn when they can
+        popens = []
+        sh = Shell(exit_callback=lambda cmd, sp, res: popens.append(sp.__class__))
+        for spawn in ('fork', 'posix_spawn'):
+            self.assertEqual(sh.sh('-c', 'ulimit -n', rlimits={'nofile': 64}, spawn=spawn).stdout, b'64\n')
+        self.assertEqual(sh.sh('-c', 'ulimit -n', rlimits={'nofile': 64}, preexec_fn=lambda: None).stdout, b'64\n')
+        sh.true()
+        self.assertEqual(popens, [whelk.ServerPopen, whelk.ServerPopen, subprocess.Popen, subprocess.Popen])
+
+    def test_defaults(self):
+        sh = Shell(rlimits={'nofile': 64})
+        self.assertEqual(sh.sh('-c', 'ulimit -n').stdout, b'64\n')
+
+    def test_pipe(self):
+        r = pipe(pipe.sh('-c', 'ulimit -n', rlimits={'nofile': 64}) | pipe.sh('-c', 'cat; ulimit -n', rlimits={'nofile': 32}))
+        self.assertEqual(r.stdout, b'64\n32\n')
+
+    def test_invalid(self):
+        # A limit that can't be set does not leave the command running
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if hard == resource.RLIM_INFINITY:
+            self.skipTest("No hard limit to exceed")
+        self.assertRaises(subprocess.SubprocessError, shell.sleep, 10, rlimits={'nofile': hard + 1}, preexec_fn=lambda: None)
+        self.assertRaises(OSError, shell.sleep, 10, rlimits={'nofile': hard + 1})
+
+    def test_async(self):
+        sh = AsyncShell()
+        r = asyncio.run(sh.sh('-c', 'ulimit -n', rlimits={'nofile': 64}))
+        self.assertEqual(r.stdout, b'64\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+from whelk.tests import *
+import asyncio
+import io
+import time
+
+class MapTest(unittest.TestCase):
+    """Tests running many commands in parallel"""
+    def test_map(self):
+        results = list(shell.map('test_return', [(x, x) for x in range(20)], max_workers=4))
+        self.assertEqual([r.returncode for r in results], list(range(20)))
+        self.assertEqual([r.stdout for r in results], [b'%d\n' % x for x in range(20)])
+
+        results = list(shell.map(shell.cat, [[]] * 10, input=b'hello'))
+        self.assertEqual([r.stdout for r in results], [b'hello'] * 10)
+
+    def test_parallel(self):
+        start = time.time()
+        results = list(shell.map('sleep', ['0.2'] * 8, max_workers=8))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(results), 8)
+
+    def test_unordered(self):
+        results = list(shell.map('sleep', ['0.3', '0'], max_workers=2, ordered=False))
+        self.assertEqual([r.returncode for r in results], [0, 0])
+
+    def test_callbacks(self):
+        exits = []
+        s = Shell(exit_callback=lambda command, sp, res: exits.append(res.returncode))
+        list(s.map('test_return', range(5)))
+        self.assertEqual(sorted(exits), list(range(5)))
+
+    def test_raises(self):
+        results = shell.map('test_return', [0, 1, 0], raise_on_error=True)
+        self.assertEqual(next(results).returncode, 0)
+        self.assertRaises(CommandFailed, lambda: next(results))
+
+    def test_fail_fast(self):
+        started = []
+        s = Shell(run_callback=lambda command: started.append(command.args))
+        results = s.map('test_return', [1] + [0] * 100, max_workers=1, fail_fast=True)
+        self.assertRaises(CommandFailed, lambda: list(results))
+        self.assertTrue(len(started) < 100)
+
+    def test_fail_fast_unordered(self):
+        # Skipped commands finish before the failed one, but only the failure
+        # is reported
+        argsets = [('-c', 'exit 1' if x == 3 else 'exit 0') for x in range(40)]
+        for _ in range(10):
+            results = shell.map('sh', argsets, max_workers=8, ordered=False, fail_fast=True)
+            self.assertRaises(CommandFailed, lambda: list(results))
+
+        async def fail_fast():
+            return [r async for r in AsyncShell().map('sh', argsets, max_workers=8, ordered=False, fail_fast=True)]
+        self.assertRaises(CommandFailed, lambda: asyncio.run(fail_fast()))
+
+    def test_async(self):
+        async def main():
+            return [r async for r in AsyncShell().map('test_return', range(10), max_workers=3)]
+        results = asyncio.run(main())
+        self.assertEqual([r.returncode for r in results], list(range(10)))
+
+        async def fail_fast():
+            return [r async for r in AsyncShell().map('test_return', [0, 1, 0], fail_fast=True)]
+        self.assertRaises(CommandFailed, lambda: asyncio.run(fail_fast()))
+
+    def test_batched(self):
+        # More arguments than fit in a single command
+        size = min(os.sysconf('SC_ARG_MAX'), 8 * 1024 * 1024)
+        args = ['argument-%07d' % x for x in range(size // 16 + 1)]
+        r = shell.batched('echo', args)
+        self.assertTrue(len(r.returncode) > 1)
+        self.assertTrue(r)
+        self.assertEqual(r.stdout.split(), [arg.encode() for arg in args])
+        self.assertEqual(len(r.usage), len(r.returncode))
+
+    def test_batched_order(self):
+        r = shell.batched('test_return', range(10), initial=[0], max_args=1, max_workers=4)
+        self.assertEqual(r.returncode, [0] * 10)
+        self.assertEqual(r.stdout, b''.join(b'%d\n' % x for x in range(10)))
+        r = shell.batched(shell.echo, 'abcdefg', initial=['-n'], max_args=3, encoding='utf-8')
+        self.assertEqual((r.returncode, r.stdout), ([0, 0, 0], 'a b cd e fg'))
+
+    def test_batched_empty(self):
+        started = []
+        s = Shell(run_callback=lambda command: started.append(command.args))
+        self.assertEqual(s.batched('echo', []), ([], b'', b''))
+        self.assertEqual(s.batched('echo', iter([]), encoding='utf-8').stdout, '')
+        self.assertEqual(started, [])
+
+    def test_batched_errors(self):
+        r = shell.batched('test_return', [1, 0, 0], max_args=2)
+        self.assertEqual(r.returncode, [1, 0])
+        self.assertFalse(r)
+        self.assertRaises(CommandFailed, shell.batched, 'test_return', [1] + [0] * 10, max_args=1, max_workers=1, fail_fast=True)
+        self.assertRaises(ValueError, shell.batched, 'echo', ['a'], stream=True)
+        self.assertRaises(ValueError, shell.batched, 'echo', ['a'], max_args=0)
+
+    def test_batched_targets(self):
+        # Output that doesn't come back to whelk is still in order
+        args = range(50)
+        expected = b''.join(b'%d\n' % x for x in args)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out')
+            r = shell.batched('echo', args, max_args=1, stdout=path)
+            self.assertIsNone(r.stdout)
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), expected)
+            with open(path, 'wb') as fd:
+                shell.batched('echo', args, max_args=1, stdout=fd)
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), expected)
+        finally:
+            shutil.rmtree(tmp)
+        out = io.BytesIO()
+        r = shell.batched('echo', args, max_args=1, stdout=out)
+        self.assertEqual((r.stdout, out.getvalue()), (None, expected))
+        buf = bytearray(10)
+        r = shell.batched('echo', args, max_args=1, stdout=buf)
+        self.assertEqual((bytes(r.stdout), buf), (expected[:10], expected[:10]))
+
+    def test_batched_async(self):
+        r = asyncio.run(AsyncShell().batched('echo', range(10), max_args=3, max_workers=2))
+        self.assertEqual(r.returncode, [0] * 4)
+        self.assertEqual(r.stdout, b'0 1 2\n3 4 5\n6 7 8\n9\n')
+
+    def test_real_xargs(self):
+        p = Pipe()
+        r = p(p.echo('hello world') | p.xargs('-n1', 'echo'))
+        self.assertEqual(r.stdout, b'hello\nworld\n')
+        self.assertEqual(shell.xargs('echo', input=b'a b').stdout, b'a b\n')
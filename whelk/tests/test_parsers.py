@@ -0,0 +1,62 @@
+from whelk.tests import *
+import whelk
+
+class ParserTest(unittest.TestCase):
+    """Tests for parsing output into records"""
+    def test_records(self):
+        r = shell.printf('a\\0b c\\0\\0d\\0')
+        self.assertEqual(list(r.records('\0')), [b'a', b'b c', b'', b'd'])
+        self.assertEqual(list(r.records(b'\0', encoding='utf-8')), ['a', 'b c', '', 'd'])
+        r = shell.printf('a\\nb', encoding='utf-8')
+        self.assertEqual(list(r.records()), ['a', 'b'])
+
+    def test_chunk_boundaries(self):
+        # Records and characters that span chunks
+        data = ''.join('%dé\r\n' % i for i in range(50000)).encode('utf-8')
+        r = shell.cat(input=data)
+        self.assertGreater(len(data), whelk.IOPump.read_size)
+        records = list(r.records('\r\n', encoding='utf-8'))
+        self.assertEqual(len(records), 50000)
+        self.assertEqual(records[12345], '12345é')
+
+    def test_long_records(self):
+        # Records longer than a chunk, with a separator split over two chunks
+        size = whelk.IOPump.read_size
+        data = b'x' * (size * 3 - 1) + b'\r\n' + b'y' * size + b'\r\nz'
+        r = shell.cat(input=data)
+        self.assertEqual([len(record) for record in r.records('\r\n')], [size * 3 - 1, size, 1])
+
+    def test_fields(self):
+        r = shell.printf('root:x:0:0:root:/root:/bin/bash\\nnobody:x:65534:65534::/:\\n')
+        self.assertEqual(list(r.fields()), [[b'root', b'x', b'0', b'0', b'root', b'/root', b'/bin/bash'],
+                                            [b'nobody', b'x', b'65534', b'65534', b'', b'/', b'']])
+        self.assertEqual([f[0] for f in r.fields(maxsplit=1, encoding='utf-8')], ['root', 'nobody'])
+
+    def test_json_lines(self):
+        r = shell.printf('{"a": 1}\\n\\n[1, "\\xc3\\xa9"]\\n')
+        self.assertEqual(list(r.json_lines()), [{'a': 1}, [1, 'é']])
+
+    def test_csv(self):
+        r = shell.printf('name,comment\\nx,"a, b"\\ny,"multi\\nline"\\n')
+        self.assertEqual(list(r.csv(encoding='utf-8')), [['name', 'comment'], ['x', 'a, b'], ['y', 'multi\nline']])
+        r = shell.printf('a;b\\n', encoding='utf-8')
+        self.assertEqual(list(r.csv(delimiter=';')), [['a', 'b']])
+
+    def test_spilled(self):
+        r = shell.seq(100000, spill=1000)
+        self.assertIsInstance(r.stdout, whelk.MappedOutput)
+        self.assertEqual(sum(int(x) for x in r.records()), 5000050000)
+
+    def test_stream(self):
+        with shell.seq(3, stream=True) as stream:
+            self.assertEqual(list(stream.records(encoding='ascii')), ['1', '2', '3'])
+        self.assertEqual(stream.result.returncode, 0)
+        stream = pipe(pipe.printf('a:b\\0c:d\\0') | pipe.cat(stream=True))
+        self.assertEqual(list(stream.fields(separator='\0')), [[b'a', b'b'], [b'c', b'd']])
+
+    def test_not_collected(self):
+        r = shell.echo(stdout=DEVNULL)
+        self.assertRaises(ValueError, r.records)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
 from whelk.tests import *
+import signal
+import subprocess
+import time
 
 class PipeTest(unittest.TestCase):
     """Tests pipe functionality"""
@@ -24,6 +27,11 @@ class PipeTest(unittest.TestCase):
         self.assertEqual(r.stderr, b'')
         self.assertEqual(r.stdout, b'output\n')
 
+    def test_pipe_oneprocess_input(self):
+        r = pipe(pipe.cat(input=b'Hello, world!'))
+        self.assertEqual(r.returncode, [0])
+        self.assertEqual(r.stdout, b'Hello, world!')
+
     def test_pipe_stderr(self):
         # Stderr redirection in the middle of the pipe
         r = pipe(pipe.test_return(0) | pipe.test_return(1, "", "error", stderr=STDOUT) | pipe.cat())
@@ -52,3 +60,41 @@ class PipeTest(unittest.TestCase):
         self.assertEqual(r.returncode, [0,0,0])
         self.assertEqual(r.stdout, input)
         self.assertEqual(r.stderr, b'')
+
+    def test_stage_stderr(self):
+        # Errors of all commands are collected, even if there's lots of them
+        r = pipe(pipe.sh('-c', 'head -c 1000000 /dev/zero >&2; echo out') | pipe.sh('-c', 'cat; echo err >&2') | pipe.cat())
+        self.assertEqual(r.returncode, [0, 0, 0])
+        self.assertEqual(r.stdout, b'out\n')
+        self.assertEqual(r.stderr, b'')
+        self.assertEqual(len(r.stage_stderr[0]), 1000000)
+        self.assertEqual(r.stage_stderr[1:], [b'err\n', b''])
+        self.assertIsNone(shell.true().stage_stderr)
+
+    def test_stage_stderr_stream(self):
+        stream = pipe(pipe.sh('-c', 'echo err >&2; seq 3') | pipe.cat(stream=True))
+        self.assertEqual(list(stream), [b'1\n', b'2\n', b'3\n'])
+        self.assertEqual(stream.result.stage_stderr, [b'err\n', b''])
+
+    def test_early_exit(self):
+        # A failing command stops the commands before it
+        start = time.time()
+        r = pipe(pipe.sleep(10) | pipe.sleep(10) | pipe.false())
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(r.returncode, [-signal.SIGPIPE, -signal.SIGPIPE, 1])
+        # Successful commands don't
+        r = pipe(pipe.sh('-c', 'sleep 0.2; exit 3') | pipe.true())
+        self.assertEqual(r.returncode, [3, 0])
+
+    def test_timeout(self):
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired) as ctx:
+            pipe(pipe.sh('-c', 'echo partial; exec sleep 10') | pipe.cat(timeout=0.2))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ctx.exception.output, b'partial\n')
+        self.assertRaises(subprocess.TimeoutExpired, shell.sleep, 10, timeout=0.2)
+        self.assertEqual(shell.echo('hi', timeout=5).stdout, b'hi\n')
+
+    def test_fanout_stage_stderr(self):
+        r = pipe(pipe.test_return(0, 'a', 'e1') | pipe.fanout(pipe.test_return(0, 'b', 'e2') | pipe.cat(), pipe.cat()))
+        self.assertEqual(r.stage_stderr, [b'e1\n', [b'e2\n', b''], [b'']])
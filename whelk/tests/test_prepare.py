@@ -0,0 +1,59 @@
+from whelk.tests import *
+import asyncio
+
+class PrepareTest(unittest.TestCase):
+    """Tests for prepared commands"""
+    def test_prepare(self):
+        grep = shell.prepare('grep', '-F', encoding='utf-8')
+        r = grep('foo', input='foo\nbar\nfood\n')
+        self.assertEqual(r, (0, 'foo\nfood\n', ''))
+        r = grep('bar', input='foo\nbar\nfood\n')
+        self.assertEqual(r.stdout, 'bar\n')
+        r = grep('-c', 'baz', input='foo\nbar\nfood\n')
+        self.assertEqual(r.returncode, 1)
+
+    def test_fixed_input(self):
+        wc = shell.prepare(shell.wc, '-l', input=b'1\n2\n3\n')
+        self.assertEqual(wc().stdout.strip(), b'3')
+        self.assertEqual(wc(input=b'1\n').stdout.strip(), b'1')
+
+    def test_file_input(self):
+        # A file as fixed input can be replaced by other input, and back
+        with open(__file__, 'rb') as fd:
+            data = fd.read()
+        with open(__file__, 'rb') as fd:
+            cat = shell.prepare('cat', input=fd)
+            self.assertEqual(cat(input=b'bytes\n').stdout, b'bytes\n')
+            self.assertEqual(cat().stdout, data)
+        cat = shell.prepare('cat')
+        with open(__file__, 'rb') as fd:
+            self.assertEqual(cat(input=fd).stdout, data)
+        self.assertEqual(cat(input=b'bytes\n').stdout, b'bytes\n')
+
+    def test_kwargs(self):
+        cat = Shell(encoding='utf-8').prepare('cat', raise_on_error=True)
+        self.assertRaises(CommandFailed, cat, '/nonexistent')
+        r = cat(input=b'hello', encoding=None)
+        self.assertEqual(r.stdout, b'hello')
+
+    def test_sinks(self):
+        outputs = []
+        def cb(cmd, sp, res):
+            outputs.append(bytes(res.stdout))
+        echo = shell.prepare('echo', stdout=bytearray(3), exit_callback=cb)
+        echo('foo')
+        echo('bar')
+        self.assertEqual(outputs, [b'foo', b'bar'])
+
+    def test_pipe(self):
+        grep = pipe.prepare('grep', '-v')
+        r = pipe(pipe.echo('foo\nbar') | grep('foo'))
+        self.assertEqual(r, ([0, 0], b'bar\n', b''))
+        r = pipe(pipe.echo('foo\nbar') | grep('bar'))
+        self.assertEqual(r, ([0, 0], b'foo\n', b''))
+
+    def test_async(self):
+        echo = AsyncShell().prepare('echo', '-n')
+        async def main():
+            return await asyncio.gather(echo('foo'), echo('bar'))
+        self.assertEqual([r.stdout for r in asyncio.run(main())], [b'foo', b'bar'])
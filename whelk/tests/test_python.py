@@ -0,0 +1,55 @@
+from whelk.tests import *
+import signal
+
+def numbers(lines, count):
+    for i in range(int(count)):
+        yield '%d\n' % i
+
+class PythonStageTest(unittest.TestCase):
+    """Tests for python functions as pipe stages"""
+    def test_filter(self):
+        r = pipe(pipe.printf('c\\nb\\na\\nbb\\n') | pipe.py(lambda lines: (l.upper() for l in lines if b'b' in l)) | pipe.sort())
+        self.assertEqual(r, ([0, 0, 0], b'B\nBB\n', b''))
+
+    def test_text(self):
+        r = pipe(pipe.cat(input='x\ny\n', encoding='utf-8') | pipe.py(lambda lines: [l * 2 for l in lines], encoding='utf-8'))
+        self.assertEqual(r.stdout, 'x\nx\ny\ny\n')
+        self.assertEqual(r.stderr, None)
+
+    def test_first_stage(self):
+        r = pipe(pipe.py(numbers, 10, encoding='utf-8') | pipe.wc('-l'))
+        self.assertEqual(r, ([0, 0], b'10\n', b''))
+        r = pipe(pipe.py(lambda lines: lines, input=b'a\nb\n') | pipe.tac())
+        self.assertEqual(r.stdout, b'b\na\n')
+
+    def test_return_value(self):
+        # Functions can return all their output at once
+        r = pipe(pipe.echo('hello') | pipe.py(lambda f: f.read().upper()))
+        self.assertEqual(r, ([0, 0], b'HELLO\n', None))
+        r = pipe(pipe.echo('hello') | pipe.py(lambda f: bytearray(f.read()[::-1])) | pipe.cat())
+        self.assertEqual(r.stdout, b'\nolleh')
+        r = pipe(pipe.echo('hello') | pipe.py(lambda f: f.read().title(), encoding='utf-8'))
+        self.assertEqual(r.stdout, 'Hello\n')
+
+    def test_consecutive(self):
+        r = pipe(pipe.seq(100) | pipe.py(lambda lines: (l for l in lines if l.endswith(b'0\n'))) | pipe.py(lambda lines: [b'%d\n' % len(list(lines))]))
+        self.assertEqual(r, ([0, 0, 0], b'10\n', None))
+
+    def test_returncodes(self):
+        r = pipe(pipe.py(numbers, 1000000, encoding='utf-8') | pipe.head('-n', 1))
+        self.assertEqual(r.returncode, [-signal.SIGPIPE, 0])
+        def fail(lines):
+            raise ValueError("Oops")
+        stage = pipe.py(fail)
+        r = pipe(pipe.echo('hello') | stage | pipe.cat())
+        self.assertEqual(r.returncode[1:], [1, 0])
+        self.assertIsInstance(stage.sp.exception, ValueError)
+
+    def test_shell(self):
+        r = shell.py(lambda lines: (l[::-1] for l in lines), input='abc', encoding='utf-8')
+        self.assertEqual(r, (0, 'cba', None))
+
+    def test_stream(self):
+        s = pipe(pipe.seq(5) | pipe.py(lambda lines: (b'>' + l for l in lines), stream=True))
+        self.assertEqual(list(s), [b'>1\n', b'>2\n', b'>3\n', b'>4\n', b'>5\n'])
+        self.assertEqual(s.result.returncode, [0, 0])
@@ -0,0 +1,115 @@
+from whelk.tests import *
+import subprocess
+import time
+import whelk
+
+@unittest.skipUnless(hasattr(os, 'posix_spawn'), "os.posix_spawn is not available")
+class SpawnTest(unittest.TestCase):
+    """Tests for starting processes with posix_spawn"""
+    def setUp(self):
+        self.shell = Shell(spawn='posix_spawn')
+        self.pipe = Pipe(spawn='posix_spawn')
+        self.popens = []
+        self.shell.defaults['exit_callback'] = self.pipe.defaults['exit_callback'] = lambda cmd, sp, res: self.popens.append(sp.__class__)
+
+    def test_spawn(self):
+        r = self.shell.cat(input=b'Hello, world!')
+        self.assertEqual(r, (0, b'Hello, world!', b''))
+        self.assertEqual(self.popens, [whelk.SpawnPopen])
+        r = self.shell.test_return('5')
+        self.assertEqual(r.returncode, 5)
+
+    def test_pipe(self):
+        r = self.pipe(self.pipe.echo('foo\nbar') | self.pipe.grep('bar'))
+        self.assertEqual(r, ([0, 0], b'bar\n', b''))
+
+    def test_fallback(self):
+        r = self.shell.pwd(cwd='/')
+        self.assertEqual(r.stdout, b'/\n')
+        self.assertEqual(self.popens, [subprocess.Popen])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "Needs /proc/self/fd")
+    def test_fd_hygiene(self):
+        r, w = os.pipe()
+        os.set_inheritable(w, True)
+        try:
+            fds = self.shell.ls('/proc/self/fd', encoding='ascii').stdout.split()
+            self.assertNotIn(str(w), fds)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, shell.true, spawn='clone')
+
+@unittest.skipUnless(hasattr(os, 'posix_spawn'), "os.posix_spawn is not available")
+class ServerTest(unittest.TestCase):
+    """Tests for starting processes with the spawn server"""
+    def setUp(self):
+        self.shell = Shell(spawn='server')
+        self.pipe = Pipe(spawn='server')
+
+    def test_spawn(self):
+        r = self.shell.cat(input=b'Hello, world!', exit_callback=lambda cmd, sp, res: self.assertIsInstance(sp, whelk.ServerPopen))
+        self.assertEqual(r, (0, b'Hello, world!', b''))
+        r = self.shell.test_return('5')
+        self.assertEqual(r.returncode, 5)
+        self.assertTrue(r.usage.utime is not None)
+
+    def test_pipe(self):
+        r = self.pipe(self.pipe.echo('foo\nbar') | self.pipe.grep('bar', stream=True))
+        self.assertEqual(list(r), [b'bar\n'])
+        self.assertEqual(r.result.returncode, [0, 0])
+
+    def test_cwd_env(self):
+        r = self.shell.pwd(cwd='/')
+        self.assertEqual(r.stdout, b'/\n')
+        os.environ['WHELK_SPAWN_TEST'] = 'spawned'
+        try:
+            r = self.shell.env(encoding='utf-8')
+            self.assertIn('WHELK_SPAWN_TEST=spawned\n', r.stdout)
+        finally:
+            del os.environ['WHELK_SPAWN_TEST']
+        r = self.shell.env(env={'FOO': 'bar'})
+        self.assertEqual(r.stdout, b'FOO=bar\n')
+
+    def test_errors(self):
+        self.assertRaises(FileNotFoundError, self.shell.pwd, cwd='/nonexistent')
+        cmd = whelk.Command('/nonexistent/command', defaults=self.shell.defaults)
+        self.assertRaises(FileNotFoundError, cmd)
+        self.assertEqual(self.shell.true().returncode, 0)
+
+    def test_wait(self):
+        sp = whelk.ServerPopen(['sleep', '10'])
+        self.assertEqual(sp.poll(), None)
+        self.assertRaises(subprocess.TimeoutExpired, sp.wait, 0.1)
+        sp.kill()
+        self.assertEqual(sp.wait(), -9)
+
+    def test_map(self):
+        results = list(self.shell.map('echo', range(100), max_workers=10))
+        self.assertEqual([r.stdout for r in results], [b'%d\n' % i for i in range(100)])
+
+    def run_python(self, *lines):
+        code = '\n'.join(('import os, time, whelk', 'whelk.shell.true(spawn="server")') + lines)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return shell[sys.executable]('-W', 'error::ResourceWarning', '-c', code, env=dict(os.environ, PYTHONPATH=root))
+
+    def test_stopped_at_exit(self):
+        r = self.run_python('print(whelk.spawn_server.process.pid)')
+        self.assertEqual((r.returncode, r.stderr), (0, b''))
+        self.assertRaises(ProcessLookupError, os.kill, int(r.stdout), 0)
+
+    def test_forked_child(self):
+        # A forked child doesn't keep the server running
+        start = time.time()
+        r = self.run_python(
+            'if os.fork() == 0:',
+            '    devnull = os.open(os.devnull, os.O_RDWR)',
+            '    for fd in range(3):',
+            '        os.dup2(devnull, fd)',
+            '    time.sleep(3)',
+            '    os._exit(0)',
+        )
+        self.assertEqual((r.returncode, r.stderr), (0, b''))
+        self.assertTrue(time.time() - start < 2)
@@ -0,0 +1,43 @@
+from whelk.tests import *
+import asyncio
+import whelk
+
+class SpillTest(unittest.TestCase):
+    """Tests for spilling output to disk"""
+    def test_small(self):
+        r = shell.seq(10, spill=1000)
+        self.assertEqual(r.stdout, b''.join(b'%d\n' % i for i in range(1, 11)))
+        self.assertIsInstance(r.stdout, bytes)
+
+    def test_spill(self):
+        expected = b''.join(b'%d\n' % i for i in range(1, 100001))
+        r = shell.seq(100000, spill=1000)
+        self.assertIsInstance(r.stdout, whelk.MappedOutput)
+        self.assertEqual(r.stdout, expected)
+        self.assertEqual(len(r.stdout), len(expected))
+        self.assertEqual(r.stdout[:4], b'1\n2\n')
+        self.assertEqual(r.stdout.find(b'\n99999\n'), expected.find(b'\n99999\n'))
+        lines = list(r.stdout)
+        self.assertEqual(len(lines), 100000)
+        self.assertEqual(lines[-1], b'100000\n')
+        self.assertEqual(bytes(memoryview(r.stdout)[-7:]), b'100000\n')
+        self.assertEqual(r.stderr, b'')
+
+    def test_stderr(self):
+        r = shell.sh('-c', 'seq 10000 >&2', spill=100)
+        self.assertIsInstance(r.stderr, whelk.MappedOutput)
+        self.assertEqual(r.stderr.decode().split(), [str(i) for i in range(1, 10001)])
+
+    def test_text(self):
+        r = shell.seq(10000, spill=100, encoding='utf-8')
+        self.assertIsInstance(r.stdout, str)
+
+    def test_pipe(self):
+        r = pipe(pipe.seq(100000) | pipe.cat(spill=0))
+        self.assertIsInstance(r.stdout, whelk.MappedOutput)
+        self.assertEqual(r.stdout[-7:], b'100000\n')
+
+    def test_async(self):
+        r = asyncio.run(AsyncShell(spill=1000).seq(100000))
+        self.assertIsInstance(r.stdout, whelk.MappedOutput)
+        self.assertEqual(r.stdout[-7:], b'100000\n')
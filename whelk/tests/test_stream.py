@@ -0,0 +1,55 @@
+from whelk.tests import *
+
+class StreamTest(unittest.TestCase):
+    """Tests streaming output"""
+    def test_lines(self):
+        input = b"one\ntwo\nthree"
+        s = shell.cat(input=input, stream=True)
+        self.assertEqual(list(s), [b'one\n', b'two\n', b'three'])
+        self.assertEqual(s.result.returncode, 0)
+        self.assertEqual(s.result.stdout, None)
+        self.assertEqual(s.result.stderr, b'')
+
+    def test_long_lines(self):
+        # Lines spanning many reads
+        input = b'x' * 100000 + b'\n' + b'y' * 5000 + b'\n\nz'
+        s = shell.cat(input=input, stream=True, read_size=1000)
+        self.assertEqual(list(s), [b'x' * 100000 + b'\n', b'y' * 5000 + b'\n', b'\n', b'z'])
+
+    def test_chunks(self):
+        s = shell.test_data(2, stream=True, read_size=1000)
+        chunks = list(s.chunks(4096))
+        self.assertEqual(len(chunks), 512)
+        self.assertEqual(set(len(chunk) for chunk in chunks), set([4096]))
+        self.assertEqual(s.result.returncode, 0)
+
+    def test_encoding(self):
+        input = '\u041f\u0440\u0438\u0432\u0435\u0442\n\u043c\u0438\u0440!'
+        s = shell.cat(input=input, encoding='utf-8', stream=True, read_size=3)
+        self.assertEqual(list(s), ['\u041f\u0440\u0438\u0432\u0435\u0442\n', '\u043c\u0438\u0440!'])
+        self.assertEqual(s.result.stderr, '')
+
+    def test_pipe(self):
+        s = pipe(pipe.test_data(4) | pipe.fold('-w', '1024') | pipe.test_return(3, stream=True, stderr=STDOUT))
+        self.assertEqual(list(s), [])
+        self.assertEqual(s.result.returncode[2], 3)
+        s = pipe(pipe.test_data(4) | pipe.fold('-w', '1024', stream=True))
+        self.assertEqual(sum(1 for line in s), 4096)
+        self.assertEqual(s.result.returncode, [0, 0])
+
+    def test_raises(self):
+        s = shell.test_return(1, 'output', 'error', stream=True, raise_on_error=True)
+        try:
+            list(s)
+        except CommandFailed as e:
+            self.assertEqual(e.result.returncode, 1)
+            self.assertEqual(e.result.stderr, b'error\n')
+        else:
+            self.fail("No exception was raised")
+
+    def test_close(self):
+        with shell.test_data(64, stream=True) as s:
+            for chunk in s.chunks():
+                break
+        self.assertTrue(s.result.returncode != 0)
+        self.assertEqual(s.close(), s.result)
@@ -0,0 +1,72 @@
+from whelk.tests import *
+import asyncio
+import json
+
+class TraceTest(unittest.TestCase):
+    """Tests for timelines in the Chrome trace event format"""
+    def events(self, trace, **match):
+        return [e for e in trace.events if all(e.get(k) == v for (k, v) in match.items())]
+
+    def test_command(self):
+        trace = Trace()
+        r = shell.cat(input=b'foo', trace=trace)
+        self.assertEqual(r.stdout, b'foo')
+        begin, = self.events(trace, ph='B')
+        self.assertEqual(begin['name'], 'cat')
+        self.assertEqual(begin['args']['argv'][1:], [])
+        self.assertEqual(begin['tid'], begin['args']['pid'])
+        self.assertEqual([e['name'] for e in self.events(trace, ph='i')], ['stdin closed', 'first stdout'])
+        end, = self.events(trace, ph='E')
+        self.assertEqual(end['args'], {'returncode': 0})
+        self.assertTrue(begin['ts'] <= end['ts'])
+        self.assertEqual(trace.running, {})
+        self.assertEqual(trace.streams, {})
+
+    def test_pipe(self):
+        trace = Trace()
+        p = Pipe(trace=trace)
+        r = p(p.sh('-c', 'echo err >&2; seq 3') | p.cat() | p.wc('-l'))
+        self.assertEqual(r.returncode, [0, 0, 0])
+        self.assertEqual([e['name'] for e in self.events(trace, ph='B')], ['sh', 'cat', 'wc'])
+        self.assertEqual([e['args']['argv'][1:] for e in self.events(trace, ph='B')], [['-c', 'echo err >&2; seq 3'], [], ['-l']])
+        self.assertEqual(len(self.events(trace, ph='E')), 3)
+        tids = [e['tid'] for e in self.events(trace, ph='B')]
+        self.assertEqual([e['tid'] for e in self.events(trace, name='first stderr')], tids[:1])
+        self.assertEqual([e['tid'] for e in self.events(trace, name='first stdout')], tids[2:])
+        self.assertEqual(trace.running, {})
+
+    def test_python_and_builtin(self):
+        trace = Trace()
+        p = Pipe(trace=trace)
+        p(p.seq(3) | p.py(lambda lines: lines) | p.cat())
+        self.assertEqual([e['cat'] for e in self.events(trace, ph='B')], ['process', 'thread', 'process'])
+        self.assertEqual(len(self.events(trace, ph='E')), 3)
+        Shell(builtins=True, trace=trace).wc('-l', input=b'a\nb\n')
+        builtin, = self.events(trace, ph='X')
+        self.assertEqual((builtin['name'], builtin['cat'], builtin['args']['returncode']), ('wc', 'builtin', 0))
+
+    def test_background(self):
+        trace = Trace()
+        job = shell.sleep(0.1, background=True, trace=trace)
+        job.wait()
+        self.assertEqual(len(self.events(trace, ph='E')), 1)
+
+    def test_async(self):
+        trace = Trace()
+        r = asyncio.run(AsyncShell(trace=trace).echo('hi'))
+        self.assertEqual(r.stdout, b'hi\n')
+        self.assertEqual([e['ph'] for e in trace.events if e['ph'] != 'M'], ['B', 'i', 'i', 'E'])
+
+    def test_write(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'trace.json')
+            with Trace(path) as trace:
+                shell.true(trace=trace)
+            with open(path) as fd:
+                data = json.load(fd)
+            self.assertEqual(data['traceEvents'][0]['name'], 'process_name')
+            self.assertEqual([e['ph'] for e in data['traceEvents'][1:]], ['M', 'B', 'i', 'E'])
+        finally:
+            shutil.rmtree(tmp)
+
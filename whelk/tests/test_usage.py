@@ -0,0 +1,40 @@
+from whelk.tests import *
+
+class UsageTest(unittest.TestCase):
+    """Tests for resource usage accounting"""
+    def test_command(self):
+        r = shell.cat(input=b'x' * 100000)
+        u = r.usage
+        self.assertEqual((u.stdin, u.stdout, u.stderr), (100000, 100000, 0))
+        self.assertTrue(u.end >= u.start)
+        self.assertTrue(u.wall >= 0)
+        if hasattr(os, 'wait4'):
+            self.assertTrue(u.utime >= 0 and u.stime >= 0)
+            self.assertTrue(u.maxrss > 0)
+
+    def test_text(self):
+        r = shell.cat(input='€', encoding='utf-8')
+        self.assertEqual(r.stdout, '€')
+        self.assertEqual((r.usage.stdin, r.usage.stdout), (3, 3))
+
+    def test_pipe(self):
+        r = pipe(pipe.cat(input=b'foo\nbar\n') | pipe.grep('foo') | pipe.wc('-c'))
+        self.assertEqual(len(r.usage), 3)
+        self.assertEqual([u.stdin for u in r.usage], [8, None, None])
+        self.assertEqual([u.stdout for u in r.usage], [None, None, 2])
+        for u in r.usage:
+            self.assertTrue(u.wall >= 0)
+
+    def test_file(self):
+        r = shell.cat(input=open(__file__, 'rb'), stdout=os.devnull)
+        self.assertEqual((r.usage.stdin, r.usage.stdout), (None, None))
+
+    def test_stream(self):
+        with shell.cat(input=b'foo\n' * 1000, stream=True) as s:
+            self.assertEqual(len(list(s)), 1000)
+        self.assertEqual(s.result.usage.stdout, 4000)
+
+    def test_returncode(self):
+        r = shell.test_return('3')
+        self.assertEqual(r.returncode, 3)
+        self.assertTrue(r.usage.wall >= 0)